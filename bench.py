@@ -0,0 +1,299 @@
+"""Бенчмарки бота.
+
+    python bench.py kb [-n 20000]   — клавіатури/шаблони: нові на кожну відповідь vs спільні
+    python bench.py handlers [--users 1000] [--cards 100] [--ops 2000] [-c 32] [kartka attack ...]
+                                    — справжні хендлери на тимчасовій game.db, відповіді в заглушку
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from telegram import Bot, Update
+from telegram.ext import Application, CallbackContext
+
+import bot
+
+# Що робить PTB з reply_markup на кожному вихідному повідомленні: to_dict() -> json
+def serialize(markup) -> str:
+    return json.dumps(markup.to_dict(), ensure_ascii=False)
+
+def old_start_text(path: str) -> str:
+    # так /start збирав текст до спільного шаблону
+    return (
+        "Привіт! Я бот-гра з картками 🃏\n\n"
+        "Команди (можна і кнопками нижче):\n"
+        "/kartka — отримати карту (кулдаун 15 хв)\n"
+        "/kolektsiia — твоя колекція\n"
+        "/obmin10 <card_id> — 10 однакових -> легендарка 🎁\n\n"
+        "Рейд:\n"
+        "/raid\n"
+        "/attack <card_id>\n\n"
+        "Дуелі:\n"
+        "/duel <@user|user_id>\n"
+        "/duel_accept <id>\n"
+        "/duel_decline <id>\n\n"
+        "Подарунок:\n"
+        "/give <card_id> <qty> <@user|user_id>\n\n"
+        "Торговець:\n"
+        "/trader /sell /buy\n\n"
+        "Персонаж:\n"
+        "/me /equip /travel_start /travel_claim\n\n"
+        "Твій шлях: " + (path if path else "❓ не обрано") +
+        "\n\n(Адмін-команди приховані і тут не показуються.)"
+    )
+
+# (мкс CPU на виклик, пік пам'яті на виклик у байтах, скільки з неї лишається живим)
+def measure(fn, n: int) -> tuple[float, float, float]:
+    for _ in range(min(n, 1000)):
+        fn()
+
+    t0 = time.process_time()
+    for _ in range(n):
+        fn()
+    cpu = time.process_time() - t0
+
+    # окремий прогін під tracemalloc: він сам сповільнює код
+    k = min(n, 2000)
+    peak = kept = 0
+    keep = []
+    tracemalloc.start()
+    for _ in range(k):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        keep.append(fn())
+        cur, top = tracemalloc.get_traced_memory()
+        peak += top - base
+        kept += cur - base
+    tracemalloc.stop()
+    return cpu / n * 1e6, peak / k, kept / k
+
+def bench_kb(n: int) -> None:
+    cases = [
+        ("main menu: build", lambda: bot.build_kb(bot.MAIN_MENU_LAYOUT)),
+        ("main menu: shared", lambda: bot.MAIN_MENU_KB),
+        ("main menu: build+serialize", lambda: serialize(bot.build_kb(bot.MAIN_MENU_LAYOUT))),
+        ("main menu: shared+serialize", lambda: serialize(bot.MAIN_MENU_KB)),
+        ("path kb: build+serialize", lambda: serialize(bot.build_kb(bot.PATH_LAYOUT))),
+        ("path kb: shared+serialize", lambda: serialize(bot.PATH_KB)),
+        ("/start text: concat", lambda: old_start_text("гей")),
+        ("/start text: prebuilt", lambda: bot.START_TEXTS.get("гей")),
+    ]
+    print(f"{'case':32} {'us/call':>9} {'peak B':>9} {'kept B':>9}")
+    for name, fn in cases:
+        us, peak, kept = measure(fn, n)
+        print(f"{name:32} {us:9.2f} {peak:9.0f} {kept:9.0f}")
+
+# ================== HANDLERS ==================
+# Бот без мережі: усе, що хендлери надсилають, просто відкидається.
+class StubBot(Bot):
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return None
+
+    async def send_photo(self, chat_id, photo, *args, **kwargs):
+        return None
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        return True
+
+    async def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        return True
+
+_ids = itertools.count(1)
+
+def make_update(tg_bot: Bot, uid: int, text: str = "", callback_data: str = "") -> Update:
+    user = {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+    msg = {"message_id": next(_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": user}
+    if callback_data:
+        msg["from"] = {"id": 1, "is_bot": True, "first_name": "bot"}
+        data = {"update_id": next(_ids), "callback_query": {
+            "id": str(next(_ids)), "from": user, "chat_instance": "bench", "data": callback_data, "message": msg,
+        }}
+    else:
+        msg["text"] = text
+        data = {"update_id": next(_ids), "message": msg}
+    return Update.de_json(data, tg_bot)
+
+CARDS_PER_USER = 20
+CARD_COUNT = 50
+
+# картки, які має користувач uid (щоб /attack і /give мали що брати)
+def owned_cards(uid: int, cards: int) -> list[int]:
+    return [(uid + j) % cards + 1 for j in range(min(CARDS_PER_USER, cards))]
+
+def seed_db(users: int, cards: int) -> None:
+    rarities = list(bot.RARITY_CHANCE)
+    paths = sorted(bot.PATH_ALLOWED)
+    now = int(time.time())
+    with bot.db() as con:
+        bot.migrate(con)
+        with bot.transaction(con):
+            con.executemany(
+                "INSERT INTO cards(name,rarity,weight,photo_file_id,description) VALUES(?,?,1,?,?)",
+                [(f"Карта {i}", rarities[i % len(rarities)], f"photo{i}", "bench") for i in range(cards)],
+            )
+            con.executemany(
+                "INSERT INTO users(user_id, username, first_name, path, coins, last_seen_ts) VALUES(?,?,?,?,?,?)",
+                [(u, f"user{u}", f"u{u}", paths[u % len(paths)], 10**9, now) for u in range(1, users + 1)],
+            )
+            con.executemany("INSERT INTO cooldowns(user_id) VALUES(?)", [(u,) for u in range(1, users + 1)])
+            con.executemany(
+                "INSERT INTO user_cards(user_id, card_id, count) VALUES(?,?,?)",
+                [(u, c, CARD_COUNT) for u in range(1, users + 1) for c in owned_cards(u, cards)],
+            )
+            bot.refresh_user_stats(con, list(range(1, users + 1)))
+            # рейд, який не закінчиться під час заміру
+            con.execute(
+                "INSERT INTO daily_state(day, raid_active, raid_hp, raid_hp_max, raid_killed, trader_seed) VALUES(?,1,?,?,0,?)",
+                (bot.today_key(), 10**9, 10**9, 42),
+            )
+        bot.set_catalog(bot.load_catalog(con))
+    bot.KNOWN_USERS.update(range(1, users + 1))
+
+def make_duels(pairs: list[tuple[int, int]]) -> list[int]:
+    now = int(time.time())
+    with bot.db() as con:
+        with bot.transaction(con):
+            ids = []
+            for a, b_ in pairs:
+                con.execute("INSERT INTO duels(from_user,to_user,status,ts) VALUES(?,?, 'pending', ?)", (a, b_, now))
+                ids.append(con.execute("SELECT last_insert_rowid()").fetchone()[0])
+    return ids
+
+MENU_BUTTONS = ["menu:get_card", "menu:collection", "menu:raid", "menu:trader", "menu:me", "menu:back"]
+
+# [(handler, update, args)] для одного хендлера; все готується до заміру
+def make_ops(name: str, n: int, tg_bot: Bot, users: int, cards: int) -> list[tuple]:
+    rnd = random.Random(name)
+    uids = [rnd.randint(1, users) for _ in range(n)]
+
+    if name == "kartka":
+        return [(bot.kartka, make_update(tg_bot, u, "/kartka"), []) for u in uids]
+    if name == "attack":
+        return [(bot.attack, make_update(tg_bot, u, "/attack"), [str(rnd.choice(owned_cards(u, cards)))]) for u in uids]
+    if name == "kolektsiia":
+        return [(bot.kolektsiia, make_update(tg_bot, u, "/kolektsiia"), []) for u in uids]
+    if name == "give":
+        ops = []
+        for u in uids:
+            to = rnd.randint(1, users - 1)
+            to += to >= u
+            ops.append((bot.give, make_update(tg_bot, u, "/give"), [str(rnd.choice(owned_cards(u, cards))), "1", str(to)]))
+        return ops
+    if name == "buy":
+        items = list(bot.trader_offer(bot.DAILY).items)
+        return [(bot.buy, make_update(tg_bot, u, "/buy"), [rnd.choice(items)]) for u in uids]
+    if name == "duel_accept":
+        pairs = []
+        for u in uids:
+            frm = rnd.randint(1, users - 1)
+            pairs.append((frm + (frm >= u), u))
+        ids = make_duels(pairs)
+        return [(bot.duel_accept, make_update(tg_bot, u, "/duel_accept"), [str(did)]) for (_, u), did in zip(pairs, ids)]
+    if name == "me":
+        return [(bot.me, make_update(tg_bot, u, "/me"), []) for u in uids]
+    if name == "on_menu_button":
+        return [(bot.on_menu_button, make_update(tg_bot, u, callback_data=rnd.choice(MENU_BUTTONS)), []) for u in uids]
+    raise ValueError(name)
+
+HANDLERS = ["kartka", "attack", "kolektsiia", "give", "buy", "duel_accept", "me", "on_menu_button"]
+
+def pct(sorted_ms: list[float], p: float) -> float:
+    return sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * p))]
+
+# (ops/sec, p50 мс, p99 мс, помилок)
+async def run_ops(app: Application, ops: list[tuple], concurrency: int) -> tuple[float, float, float, int]:
+    jobs = []
+    for handler, update, args in ops:
+        ctx = CallbackContext.from_update(update, app)
+        ctx.args = args
+        jobs.append((handler, update, ctx))
+
+    lat: list[float] = []
+    errors = 0
+    it = iter(jobs)
+
+    async def worker():
+        nonlocal errors
+        for handler, update, ctx in it:
+            t0 = time.perf_counter()
+            try:
+                await handler(update, ctx)
+            except Exception:
+                errors += 1
+            lat.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return len(jobs) / wall, statistics.median(lat), pct(lat, 0.99), errors
+
+async def bench_handlers_async(args) -> None:
+    tg_bot = StubBot("1:bench")
+    app = Application.builder().bot(tg_bot).updater(None).build()
+
+    seed_db(args.users, args.cards)
+    await bot.ensure_today()
+    if not args.cooldowns:
+        # інакше після першого ж виклику кожен /kartka і /attack — лише відмова по кулдауну
+        bot.COOLDOWN_KINDS = {kind: (col, 0) for kind, (col, _) in bot.COOLDOWN_KINDS.items()}
+
+    print(f"users={args.users} cards={args.cards} ops={args.ops} concurrency={args.concurrency} pool={bot.DB_POOL_SIZE}")
+    print(f"{'handler':16} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name in args.handlers:
+        ops = make_ops(name, args.ops, tg_bot, args.users, args.cards)
+        rate, p50, p99, errors = await run_ops(app, ops, args.concurrency)
+        print(f"{name:16} {rate:9.0f} {p50:8.2f} {p99:8.2f} {errors:7d}")
+
+    await bot.flush_seen_users()
+    await bot.COOLDOWNS.flush()
+    await bot.flush_raid()
+
+def bench_handlers(args) -> None:
+    unknown = [h for h in args.handlers if h not in HANDLERS]
+    if unknown:
+        raise SystemExit(f"Невідомі хендлери: {', '.join(unknown)}. Є: {', '.join(HANDLERS)}")
+
+    if not args.verbose:
+        logging.getLogger("bot").setLevel(logging.ERROR)  # без "повільний виклик БД" посеред таблиці
+
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    bot.DB = os.path.join(tmp, "game.db")
+    bot.open_pool()
+    try:
+        asyncio.run(bench_handlers_async(args))
+    finally:
+        bot.close_pool()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Бенчмарки бота")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    kb = sub.add_parser("kb", help="клавіатури і шаблони відповідей")
+    kb.add_argument("-n", type=int, default=20000, help="викликів на кейс")
+    h = sub.add_parser("handlers", help="пропускна здатність хендлерів")
+    h.add_argument("handlers", nargs="*", default=HANDLERS, help=f"які саме (за замовчуванням усі: {' '.join(HANDLERS)})")
+    h.add_argument("--users", type=int, default=1000)
+    h.add_argument("--cards", type=int, default=100)
+    h.add_argument("--ops", type=int, default=2000, help="викликів на хендлер")
+    h.add_argument("-c", "--concurrency", type=int, default=32, help="скільки апдейтів обробляється одночасно")
+    h.add_argument("--cooldowns", action="store_true", help="не вимикати кулдауни /kartka і /attack")
+    h.add_argument("-v", "--verbose", action="store_true", help="показувати лог бота (повільні виклики БД)")
+    args = p.parse_args()
+
+    if args.cmd == "kb":
+        bench_kb(args.n)
+    elif args.cmd == "handlers":
+        bench_handlers(args)
+
+if __name__ == "__main__":
+    main()
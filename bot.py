@@ -1,23 +1,110 @@
+import asyncio
+import bisect
+import functools
+import itertools
+import logging
 import os
+import queue
 import random
+import re
 import sqlite3
+import sys
+import threading
 import time
-from datetime import datetime, timezone
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import AsyncExitStack, contextmanager
+from contextvars import Context, ContextVar
+from datetime import datetime, time as dtime, timezone
+from typing import Any, Callable, Iterator, NamedTuple, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes,
-    ConversationHandler, MessageHandler, CallbackQueryHandler, filters
+    Application, BaseUpdateProcessor, CommandHandler, ContextTypes,
+    ConversationHandler, MessageHandler, CallbackQueryHandler, ExtBot, Job, JobQueue, filters
 )
 
 # ================== CONFIG ==================
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 DB = "game.db"
+# Скільки з'єднань тримає пул (відкривається один раз у main()); стільки ж і потоків БД
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# Виклики БД, довші за це (черга + виконання), пишуться в лог
+DB_SLOW_MS = float(os.getenv("DB_SLOW_MS", "50"))
+
+# PRAGMA для кожного з'єднання пулу (швидкість vs надійність під конкретний сервер).
+# WAL + synchronous=NORMAL: читачі не блокують писача, fsync лише на чекпойнті.
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = os.getenv("DB_CACHE_SIZE", "-16000")  # <0 — у КіБ, >0 — у сторінках
+DB_MMAP_SIZE = os.getenv("DB_MMAP_SIZE", "0")  # байт, 0 — без mmap
+DB_BUSY_TIMEOUT_MS = os.getenv("DB_BUSY_TIMEOUT_MS", "5000")
+DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+# Як часто скидати в БД last_seen / профілі користувачів (write-behind)
+USER_FLUSH_SECONDS = int(os.getenv("USER_FLUSH_SECONDS", "30"))
+# Як часто скидати HP рейду з пам'яті в daily_state
+RAID_FLUSH_SECONDS = int(os.getenv("RAID_FLUSH_SECONDS", "5"))
+# Скільки місць показує /raid_top
+RAID_TOP_N = int(os.getenv("RAID_TOP_N", "10"))
+# Скільки днів тримати журнал ударів raid_hits і суми raid_damage
+RAID_LOG_RETENTION_DAYS = int(os.getenv("RAID_LOG_RETENTION_DAYS", "30"))
+# Як часто перераховувати таблицю місць для /top
+TOP_REFRESH_SECONDS = int(os.getenv("TOP_REFRESH_SECONDS", "300"))
+# Дуелі: скільки живе неприйнята заявка, скільки днів тримати завершені,
+# як часто і якими пачками їх прибирати
+DUEL_TTL_SECONDS = int(os.getenv("DUEL_TTL_SECONDS", "86400"))
+DUEL_RETENTION_DAYS = int(os.getenv("DUEL_RETENTION_DAYS", "7"))
+DUEL_SWEEP_SECONDS = int(os.getenv("DUEL_SWEEP_SECONDS", "300"))
+DUEL_SWEEP_BATCH = int(os.getenv("DUEL_SWEEP_BATCH", "500"))
+# Періодичний wal_checkpoint (лише для WAL); 0 — вимкнено
+DB_CHECKPOINT_SECONDS = int(os.getenv("DB_CHECKPOINT_SECONDS", "300"))
+DB_CHECKPOINT_MODE = os.getenv("DB_CHECKPOINT_MODE", "PASSIVE")
+# Метрики хендлерів у форматі Prometheus (textfile collector); порожньо — не писати
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_FILE_SECONDS = int(os.getenv("METRICS_FILE_SECONDS", "15"))
+
+# Вихідні повідомлення (черга відправки). Ліміти Telegram: ~30 повідомлень/с на бота,
+# ~1/с в один чат; тримаємося трохи нижче
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+# Скільки при зупинці чекати, поки черга відправки спорожніє
+SEND_DRAIN_SECONDS = float(os.getenv("SEND_DRAIN_SECONDS", "10"))
+
+# Розсилка (/broadcast): повідомлень на секунду, скільки користувачів читати за одну
+# сторінку і скільки днів тримати завершені розсилки в broadcasts
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "15"))
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "50"))
+BROADCAST_RETENTION_DAYS = int(os.getenv("BROADCAST_RETENTION_DAYS", "30"))
+
+# Скільки апдейтів обробляється одночасно (різні користувачі); 1 — строго по черзі
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Як отримувати апдейти: polling (getUpdates) або webhook (вбудований HTTP-сервер PTB)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Де слухає сервер вебхука. За reverse proxy — 127.0.0.1 і TLS на проксі
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Шлях, на який Telegram шле апдейти; краще випадковий, щоб його не вгадали
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Публічна https-адреса (без шляху), яку бачить Telegram. Порожньо — локальний режим:
+# вебхук у Telegram не реєструється, апдейти можна слати POST-ом вручну
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Заголовок X-Telegram-Bot-Api-Secret-Token; запити без нього сервер відкидає
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сертифікат і ключ, якщо TLS термінує сам бот; порожньо — TLS на проксі
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+log = logging.getLogger("bot")
 
 # 15 хвилин
 CARD_COOLDOWN_SECONDS = 15 * 60
@@ -52,27 +139,447 @@ RARITY_SELL = {
 # Мемні "шляхи"
 PATH_ALLOWED = {"гей", "натурал", "лесбійка"}
 
+# Скільки карток на одній сторінці /kolektsiia
+COLLECTION_PAGE_SIZE = int(os.getenv("COLLECTION_PAGE_SIZE", "20"))
+
 # ================== ADMIN ADD CARD DIALOG ==================
 WAIT_PHOTO, WAIT_NAME, WAIT_RARITY, WAIT_DESC, CONFIRM = range(5)
 
+# ================== OUTBOUND QUEUE ==================
+# Пріоритети: менше — раніше. Відповіді гравцям завжди випереджають розсилки.
+LANE_INTERACTIVE = 0
+LANE_BROADCAST = 1
+
+# Токен-бакет з резервуванням: reserve() одразу забирає токен (можна в борг)
+# і повертає, скільки чекати до моменту, коли цей токен насправді доступний.
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # 429 від Telegram: до now + seconds з цього бакета нічого не видається
+    def pause(self, now: float, seconds: float) -> None:
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+# Черга відправки. Хендлер кладе сюди "як надіслати" (factory -> coroutine) і одразу
+# завершується. У кожного чату своя FIFO-черга, і в спільній пріоритетній черзі
+# завжди лише її голова: так повідомлення одного чату йдуть строго по порядку і
+# не частіше за ліміт чату, а чат, якому ще рано, не тримає воркера — його голова
+# повертається в спільну чергу рівно на зарезервований слот. Глобальний ліміт
+# воркери витримують перед кожною відправкою.
+class SendQueue:
+    def __init__(self):
+        self._queue: "asyncio.PriorityQueue[tuple[int, int, list]]" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._global = TokenBucket(SEND_GLOBAL_RATE, 1)  # рівномірно, без сплесків
+        self._buckets: dict[int, TokenBucket] = {}
+        self._chats: dict[int, "deque[tuple[int, int, list]]"] = {}
+        self._workers: list[asyncio.Task] = []
+        self._backlog = {LANE_INTERACTIVE: 0, LANE_BROADCAST: 0}
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._worker(), name=f"send-{i}") for i in range(max(1, SEND_WORKERS))]
+
+    async def stop(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("черга відправки не спорожніла за %.0f с: %d не надіслано",
+                        timeout, sum(self._backlog.values()))
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _drain(self) -> None:
+        while self._chats:
+            await asyncio.sleep(0.05)
+
+    def submit(self, chat_id: int, factory: Callable[[], Any], lane: int = LANE_INTERACTIVE) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._backlog[lane] += 1
+        fut.add_done_callback(lambda _f: self._backlog.__setitem__(lane, self._backlog[lane] - 1))
+        # [chat_id, factory, future, спроб]
+        item = (lane, next(self._seq), [chat_id, factory, fut, 0])
+        pending = self._chats.get(chat_id)
+        if pending:
+            pending.append(item)
+        else:
+            self._chats[chat_id] = deque([item])
+            self._schedule(chat_id)
+        return fut
+
+    # скільки ще не надіслано (у черзі, чекає слота або повтору)
+    def backlog(self, lane: int) -> int:
+        return self._backlog[lane]
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._buckets = {c: b for c, b in self._buckets.items() if c in self._chats or not b.idle(now)}
+            bucket = self._buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    # голову черги чату — у спільну чергу, щойно чат має право на наступне повідомлення
+    def _schedule(self, chat_id: int, delay: float = 0.0) -> None:
+        now = time.monotonic()
+        delay = max(delay, self._bucket(chat_id, now).reserve(now))
+        item = self._chats[chat_id][0]
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, item)
+        else:
+            self._queue.put_nowait(item)
+
+    # голова чату оброблена (надіслано або остаточна помилка) — далі наступне
+    def _advance(self, chat_id: int) -> None:
+        pending = self._chats[chat_id]
+        pending.popleft()
+        if pending:
+            self._schedule(chat_id)
+        else:
+            del self._chats[chat_id]
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._send(item)
+            except Exception:
+                log.exception("черга відправки: непередбачена помилка")
+            finally:
+                self._queue.task_done()
+
+    async def _send(self, item: tuple) -> None:
+        job = item[2]
+        chat_id, factory, fut, attempts = job
+        if fut.done():  # скасовано тим, хто чекав
+            return self._advance(chat_id)
+
+        wait = self._global.reserve(time.monotonic())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        try:
+            res = await factory()
+        except RetryAfter as e:
+            delay = float(e.retry_after)
+            self._bucket(chat_id, time.monotonic()).pause(time.monotonic(), delay)
+            self._retry(job, delay, e)
+        except (Forbidden, BadRequest) as e:
+            self._fail(job, e)
+        except NetworkError as e:
+            self._retry(job, min(30.0, 0.5 * 2 ** attempts), e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            if not fut.done():
+                fut.set_result(res)
+            self._advance(chat_id)
+
+    # голова лишається на місці, тож порядок у чаті не ламається
+    def _retry(self, job: list, delay: float, exc: Exception) -> None:
+        job[3] += 1
+        if job[3] > SEND_MAX_RETRIES:
+            return self._fail(job, exc)
+        self._schedule(job[0], delay)
+
+    def _fail(self, job: list, exc: Exception) -> None:
+        if not isinstance(exc, Forbidden):  # гравець заблокував бота — звична справа
+            log.warning("не вдалося надіслати в чат %s: %s", job[0], exc)
+        if not job[2].done():
+            job[2].set_exception(exc)
+        self._advance(job[0])
+
+SENDER = SendQueue()
+
+def _ignore_result(fut: asyncio.Future) -> None:
+    if not fut.cancelled():
+        fut.exception()  # помилку вже залоговано в черзі
+
+# Відправка через чергу. Поки черга не запущена (скрипти, бенчмарк) — напряму.
+async def send(chat_id: int, factory: Callable[[], Any], lane: int = LANE_INTERACTIVE):
+    if not SENDER.running:
+        return await factory()
+    SENDER.submit(chat_id, factory, lane).add_done_callback(_ignore_result)
+
 # ================== SAFE REPLY HELPERS (FIX FOR BUTTONS) ==================
 async def reply_text(update: Update, text: str, **kwargs):
     msg = update.effective_message
     if msg:
-        return await msg.reply_text(text, **kwargs)
+        return await send(msg.chat_id, lambda: msg.reply_text(text, **kwargs))
 
 async def reply_photo(update: Update, photo, caption: str, **kwargs):
     msg = update.effective_message
     if msg:
-        return await msg.reply_photo(photo=photo, caption=caption, **kwargs)
+        return await send(msg.chat_id, lambda: msg.reply_photo(photo=photo, caption=caption, **kwargs))
+
+async def edit_text(update: Update, text: str, **kwargs):
+    q = update.callback_query
+    if q and q.message:
+        return await send(q.message.chat_id, lambda: q.edit_message_text(text, **kwargs))
+
+# ================== METRICS ==================
+# Межі гістограми латентності хендлера, секунди (+Inf — останній кошик)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.db_calls = 0
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.commits = 0
+
+    def observe(self, seconds: float) -> None:
+        self.calls += 1
+        self.latency_sum += seconds
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    # верхня межа кошика, в який потрапляє квантиль q
+    def quantile(self, q: float) -> float:
+        if not self.calls:
+            return 0.0
+        acc = 0
+        for i, n in enumerate(self.buckets):
+            acc += n
+            if acc >= q * self.calls:
+                break
+        return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+
+# назва хендлера -> лічильники; змінюється лише з event loop
+METRICS: dict[str, HandlerStats] = {}
+# Чий зараз апдейт обробляється; виклики БД поза хендлерами (джоби) йдуть у "(фон)"
+BACKGROUND = "(фон)"
+CURRENT_HANDLER: ContextVar[str] = ContextVar("current_handler", default=BACKGROUND)
+
+def handler_stats(name: str) -> HandlerStats:
+    st = METRICS.get(name)
+    if st is None:
+        st = METRICS[name] = HandlerStats()
+    return st
+
+# Лічильники SQL на потоці БД: trace callback кожного з'єднання пулу рахує сюди
+class _SqlCounter(threading.local):
+    count = 0
+    commits = 0
+
+_sql = _SqlCounter()
+
+def _count_sql(statement: str) -> None:
+    _sql.count += 1
+    if statement[:6].upper() == "COMMIT":
+        _sql.commits += 1
+
+def instrumented(name: str, callback: Callable) -> Callable:
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        token = CURRENT_HANDLER.set(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_stats(name).errors += 1
+            raise
+        finally:
+            handler_stats(name).observe(time.perf_counter() - started)
+            CURRENT_HANDLER.reset(token)
+    return wrapper
+
+# APScheduler запускає джоби в контексті того, хто останнім їх планував: після
+# run_once з хендлера (schedule_travel) усі наступні джоби рахувались би на нього.
+# Тут кожна джоба, хоч звідки запланована, виконується як "(фон)".
+class BackgroundJobQueue(JobQueue):
+    @staticmethod
+    async def job_callback(job_queue: JobQueue, job: Job) -> None:
+        token = CURRENT_HANDLER.set(BACKGROUND)
+        try:
+            await JobQueue.job_callback(job_queue, job)
+        finally:
+            CURRENT_HANDLER.reset(token)
+
+# Обгортає callback кожного зареєстрованого хендлера (і всередині ConversationHandler)
+def instrument_handlers(app: Application) -> None:
+    def walk(handlers) -> None:
+        for h in handlers:
+            if isinstance(h, ConversationHandler):
+                walk(h.entry_points)
+                for state_handlers in h.states.values():
+                    walk(state_handlers)
+                walk(h.fallbacks)
+            else:
+                h.callback = instrumented(h.callback.__name__, h.callback)
+
+    for group in app.handlers.values():
+        walk(group)
+
+def render_prometheus() -> str:
+    out = [
+        "# HELP bot_handler_latency_seconds Час обробки апдейту хендлером.",
+        "# TYPE bot_handler_latency_seconds histogram",
+    ]
+    for name, st in sorted(METRICS.items()):
+        acc = 0
+        for le, n in zip([*LATENCY_BUCKETS, "+Inf"], st.buckets):
+            acc += n
+            out.append(f'bot_handler_latency_seconds_bucket{{handler="{name}",le="{le}"}} {acc}')
+        out.append(f'bot_handler_latency_seconds_sum{{handler="{name}"}} {st.latency_sum:.6f}')
+        out.append(f'bot_handler_latency_seconds_count{{handler="{name}"}} {st.calls}')
+    counters = [
+        ("bot_handler_errors_total", "Винятки в хендлері.", "errors"),
+        ("bot_handler_db_calls_total", "Виклики run_db.", "db_calls"),
+        ("bot_handler_sql_statements_total", "SQL-інструкції.", "sql_count"),
+        ("bot_handler_sql_seconds_total", "Час на потоці БД.", "sql_seconds"),
+        ("bot_handler_commits_total", "COMMIT-и.", "commits"),
+    ]
+    for metric, help_text, attr in counters:
+        out.append(f"# HELP {metric} {help_text}")
+        out.append(f"# TYPE {metric} counter")
+        for name, st in sorted(METRICS.items()):
+            out.append(f'{metric}{{handler="{name}"}} {getattr(st, attr)}')
+    return "\n".join(out) + "\n"
+
+def write_metrics_file(path: str, text: str) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)  # колектор не побачить напівзаписаний файл
+
+async def metrics_file_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.to_thread(write_metrics_file, METRICS_FILE, render_prometheus())
 
 # ================== DB ==================
 def today_key() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-def db() -> sqlite3.Connection:
-    con = sqlite3.connect(DB)
-    con.execute("""
+def _pragma_choice(name: str, raw: str, allowed: set[str]) -> str:
+    value = raw.strip().upper()
+    if value not in allowed:
+        raise RuntimeError(f"Невірне значення {name}={raw!r}. Допустимі: {', '.join(sorted(allowed))}")
+    return value
+
+def _pragma_int(name: str, raw: str) -> str:
+    try:
+        return str(int(raw))
+    except ValueError:
+        raise RuntimeError(f"{name} має бути цілим числом, а не {raw!r}") from None
+
+# PRAGMA не приймають параметрів (?), тому значення з env спершу валідуються
+def db_pragmas() -> list[tuple[str, str]]:
+    return [
+        ("busy_timeout", _pragma_int("DB_BUSY_TIMEOUT_MS", DB_BUSY_TIMEOUT_MS)),
+        ("journal_mode", _pragma_choice("DB_JOURNAL_MODE", DB_JOURNAL_MODE,
+                                        {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"})),
+        ("synchronous", _pragma_choice("DB_SYNCHRONOUS", DB_SYNCHRONOUS, {"OFF", "NORMAL", "FULL", "EXTRA"})),
+        ("cache_size", _pragma_int("DB_CACHE_SIZE", DB_CACHE_SIZE)),
+        ("mmap_size", _pragma_int("DB_MMAP_SIZE", DB_MMAP_SIZE)),
+        ("temp_store", _pragma_choice("DB_TEMP_STORE", DB_TEMP_STORE, {"DEFAULT", "FILE", "MEMORY"})),
+    ]
+
+# Фіксований набір довгоживучих з'єднань, відкривається один раз у main()
+class DbPool:
+    def __init__(self, path: str, size: int):
+        self._all: list[sqlite3.Connection] = []
+        self._free: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        pragmas = db_pragmas()
+        for _ in range(max(1, size)):
+            con = sqlite3.connect(path, check_same_thread=False)
+            for name, value in pragmas:
+                con.execute(f"PRAGMA {name}={value}")
+            con.set_trace_callback(_count_sql)
+            self._all.append(con)
+            self._free.put(con)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        con = self._free.get()
+        try:
+            yield con
+        finally:
+            # незакомічене (виняток посеред хендлера) не має потрапити до наступного позичальника
+            if con.in_transaction:
+                con.rollback()
+            self._free.put(con)
+
+    def close(self) -> None:
+        for con in self._all:
+            con.close()
+        self._all.clear()
+
+POOL: Optional[DbPool] = None
+DB_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+def open_pool() -> None:
+    global POOL, DB_EXECUTOR
+    POOL = DbPool(DB, DB_POOL_SIZE)
+    # потоків стільки ж, скільки з'єднань — потік ніколи не чекає на вільне з'єднання
+    DB_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, DB_POOL_SIZE), thread_name_prefix="db")
+
+def close_pool() -> None:
+    global POOL, DB_EXECUTOR
+    if DB_EXECUTOR is not None:
+        DB_EXECUTOR.shutdown(wait=True)
+        DB_EXECUTOR = None
+    if POOL is not None:
+        POOL.close()
+        POOL = None
+
+def db():
+    return POOL.connection()
+
+# -> (результат fn, секунд виконання, SQL-інструкцій, COMMIT-ів)
+def _db_call(fn: Callable[..., Any], args: tuple, submitted: float) -> tuple[Any, float, int, int]:
+    started = time.perf_counter()
+    _sql.count = _sql.commits = 0
+    with db() as con:
+        res = fn(con, *args)
+    done = time.perf_counter()
+    if (done - submitted) * 1000 > DB_SLOW_MS:
+        log.warning("повільний виклик БД %s: черга %.1f мс, виконання %.1f мс",
+                    fn.__name__, (started - submitted) * 1000, (done - started) * 1000)
+    return res, done - started, _sql.count, _sql.commits
+
+# Єдиний вхід до БД з async-коду: fn(con, *args) виконується на потоці БД,
+# а event loop тим часом обробляє інші апдейти.
+async def run_db(fn: Callable[..., Any], *args) -> Any:
+    loop = asyncio.get_running_loop()
+    res, seconds, statements, commits = await loop.run_in_executor(DB_EXECUTOR, _db_call, fn, args, time.perf_counter())
+    st = handler_stats(CURRENT_HANDLER.get())
+    st.db_calls += 1
+    st.sql_count += statements
+    st.sql_seconds += seconds
+    st.commits += commits
+    return res
+
+# Кроки схеми: крок N переводить БД на PRAGMA user_version = N.
+# Застосовуються один раз при старті (main -> migrate). Нові зміни — лише дописувати
+# в кінець списку; вже випущені кроки не редагувати.
+MIGRATIONS = [
+    # 1: базова схема (IF NOT EXISTS — щоб підхопити старі game.db з user_version = 0)
+    """
         CREATE TABLE IF NOT EXISTS users(
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -82,9 +589,7 @@ def db() -> sqlite3.Connection:
             equipped_weapon_id TEXT,
             raid_boost_until_ts INTEGER NOT NULL DEFAULT 0,
             last_seen_ts INTEGER NOT NULL
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS cards(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -92,24 +597,18 @@ def db() -> sqlite3.Connection:
             weight INTEGER NOT NULL DEFAULT 1,
             photo_file_id TEXT NOT NULL,
             description TEXT NOT NULL
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS user_cards(
             user_id INTEGER NOT NULL,
             card_id INTEGER NOT NULL,
             count INTEGER NOT NULL DEFAULT 0,
             PRIMARY KEY(user_id, card_id)
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS cooldowns(
             user_id INTEGER PRIMARY KEY,
             last_card_ts INTEGER NOT NULL DEFAULT 0,
             last_attack_ts INTEGER NOT NULL DEFAULT 0
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS daily_state(
             day TEXT PRIMARY KEY,
             raid_active INTEGER NOT NULL,
@@ -117,18 +616,14 @@ def db() -> sqlite3.Connection:
             raid_hp_max INTEGER NOT NULL,
             raid_killed INTEGER NOT NULL DEFAULT 0,
             trader_seed INTEGER NOT NULL
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS duels(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             from_user INTEGER NOT NULL,
             to_user INTEGER NOT NULL,
             status TEXT NOT NULL,
             ts INTEGER NOT NULL
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS inventory_items(
             user_id INTEGER NOT NULL,
             item_id TEXT NOT NULL,
@@ -137,34 +632,248 @@ def db() -> sqlite3.Connection:
             power INTEGER NOT NULL DEFAULT 0,
             qty INTEGER NOT NULL DEFAULT 1,
             PRIMARY KEY(user_id, item_id)
-        )
-    """)
-    con.execute("""
+        );
         CREATE TABLE IF NOT EXISTS travel(
             user_id INTEGER PRIMARY KEY,
             start_ts INTEGER NOT NULL,
             end_ts INTEGER NOT NULL,
             claimed INTEGER NOT NULL DEFAULT 0
-        )
-    """)
-    con.commit()
-    return con
-
-def upsert_user(con: sqlite3.Connection, update: Update) -> None:
-    u = update.effective_user
-    if not u:
-        return
+        );
+    """,
+    # 2: індекси під реальні пошуки хендлерів (перевірка: python bot.py --explain)
+    """
+        CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));
+        CREATE INDEX IF NOT EXISTS idx_cards_rarity ON cards(rarity);
+        CREATE INDEX IF NOT EXISTS idx_user_cards_card ON user_cards(card_id);
+        CREATE INDEX IF NOT EXISTS idx_duels_to_status ON duels(to_user, status);
+    """,
+    # 3: лічильники колекції на користувача (див. add_card / refresh_user_stats)
+    """
+        CREATE TABLE IF NOT EXISTS user_stats(
+            user_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            common INTEGER NOT NULL DEFAULT 0,
+            rare INTEGER NOT NULL DEFAULT 0,
+            epic INTEGER NOT NULL DEFAULT 0,
+            legendary INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR REPLACE INTO user_stats(user_id, total, common, rare, epic, legendary)
+        SELECT uc.user_id, SUM(uc.count),
+               SUM(CASE WHEN c.rarity='звичайна' THEN uc.count ELSE 0 END),
+               SUM(CASE WHEN c.rarity='рідкісна' THEN uc.count ELSE 0 END),
+               SUM(CASE WHEN c.rarity='епічна' THEN uc.count ELSE 0 END),
+               SUM(CASE WHEN c.rarity='легендарна' THEN uc.count ELSE 0 END)
+        FROM user_cards uc JOIN cards c ON c.id = uc.card_id
+        GROUP BY uc.user_id;
+    """,
+    # 4: keyset-пагінація /kolektsiia йде індексом у порядку сторінки
+    """
+        CREATE INDEX IF NOT EXISTS idx_user_cards_page ON user_cards(user_id, count DESC, card_id);
+    """,
+    # 5: розсилки з відновленням після падіння; blocked — гравець заблокував бота
+    """
+        ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0;
+        CREATE TABLE IF NOT EXISTS broadcasts(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_ts INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries(
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY(broadcast_id, user_id)
+        ) WITHOUT ROWID;
+    """,
+    # 6: журнал ударів по босу + сума урону на гравця за день (з неї топ після рестарту)
+    """
+        CREATE TABLE IF NOT EXISTS raid_hits(
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            dmg INTEGER NOT NULL,
+            ts INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_raid_hits_day_user ON raid_hits(day, user_id);
+        CREATE TABLE IF NOT EXISTS raid_damage(
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            damage INTEGER NOT NULL,
+            hits INTEGER NOT NULL,
+            PRIMARY KEY(day, user_id)
+        ) WITHOUT ROWID;
+    """,
+    # 7: знімок рейтингів /top — місце гравця і топ читаються індексом, без COUNT(*)
+    """
+        CREATE TABLE IF NOT EXISTS rank_snapshot(
+            board TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            PRIMARY KEY(board, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_rank_snapshot_rank ON rank_snapshot(board, rank);
+    """,
+    # 8: таймери повернення з подорожі; частковий індекс — лише ті, кого ще не сповістили
+    """
+        ALTER TABLE travel ADD COLUMN chat_id INTEGER;
+        ALTER TABLE travel ADD COLUMN notified INTEGER NOT NULL DEFAULT 0;
+        UPDATE travel SET notified=1 WHERE claimed=1;
+        CREATE INDEX IF NOT EXISTS idx_travel_pending ON travel(end_ts) WHERE claimed=0 AND notified=0;
+    """,
+    # 9: прибирання дуелей — прострочені заявки і старі завершені шукаються діапазоном по ts
+    """
+        CREATE INDEX IF NOT EXISTS idx_duels_status_ts ON duels(status, ts);
+    """,
+    # 10: raid_hits ніхто не читає за (day, user_id) — індекс лише гальмував дописування
+    """
+        DROP INDEX IF EXISTS idx_raid_hits_day_user;
+    """,
+]
+
+def migrate(con: sqlite3.Connection) -> int:
+    current = con.execute("PRAGMA user_version").fetchone()[0]
+    if current > len(MIGRATIONS):
+        raise RuntimeError(f"game.db має версію схеми {current}, а бот знає лише до {len(MIGRATIONS)}. Онови бота.")
+    for version, script in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        # кожен крок атомарний: або весь крок + user_version, або нічого
+        con.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;")
+    return len(MIGRATIONS)
+
+# Сила екіпірованої зброї (0, якщо нема) — один запит замість двох.
+WEAPON_POWER_SQL = """
+    SELECT COALESCE(ii.power, 0)
+    FROM users u
+    LEFT JOIN inventory_items ii
+      ON ii.user_id = u.user_id AND ii.item_id = u.equipped_weapon_id
+     AND ii.item_type = 'weapon' AND ii.qty > 0
+    WHERE u.user_id=?
+"""
+
+# Усе, що потрібно дуелі про гравця: сила зброї і кількість легендарок.
+DUEL_POWER_SQL = """
+    SELECT COALESCE(ii.power, 0), COALESCE(s.legendary, 0)
+    FROM users u
+    LEFT JOIN inventory_items ii
+      ON ii.user_id = u.user_id AND ii.item_id = u.equipped_weapon_id
+     AND ii.item_type = 'weapon' AND ii.qty > 0
+    LEFT JOIN user_stats s ON s.user_id = u.user_id
+    WHERE u.user_id=?
+"""
+
+# Сторінки колекції: порядок (count DESC, card_id ASC), курсор — (count, card_id)
+# крайнього рядка сусідньої сторінки. `count <= ?` / `count >= ?` дає індексу
+# діапазон, а OR лише відсіює рівні count — без OFFSET і без сканування початку.
+COLLECTION_FIRST_SQL = """
+    SELECT c.id, c.name, c.rarity, uc.count
+    FROM user_cards uc JOIN cards c ON c.id = uc.card_id
+    WHERE uc.user_id=? {rarity}
+    ORDER BY uc.count DESC, uc.card_id ASC
+    LIMIT ?
+"""
+COLLECTION_NEXT_SQL = """
+    SELECT c.id, c.name, c.rarity, uc.count
+    FROM user_cards uc JOIN cards c ON c.id = uc.card_id
+    WHERE uc.user_id=? AND uc.count <= ? AND (uc.count < ? OR uc.card_id > ?) {rarity}
+    ORDER BY uc.count DESC, uc.card_id ASC
+    LIMIT ?
+"""
+COLLECTION_PREV_SQL = """
+    SELECT c.id, c.name, c.rarity, uc.count
+    FROM user_cards uc JOIN cards c ON c.id = uc.card_id
+    WHERE uc.user_id=? AND uc.count >= ? AND (uc.count > ? OR uc.card_id < ?) {rarity}
+    ORDER BY uc.count ASC, uc.card_id DESC
+    LIMIT ?
+"""
+
+# сторінка отримувачів розсилки: done=1 — доставлено ще до падіння, не слати
+BROADCAST_PAGE_SQL = """
+    SELECT u.user_id, EXISTS(
+        SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = ? AND d.user_id = u.user_id
+    ) AS done
+    FROM users u
+    WHERE u.user_id > ? AND u.blocked = 0
+    ORDER BY u.user_id
+    LIMIT ?
+"""
+
+# Запити з гарячого шляху. `python bot.py --explain` показує EXPLAIN QUERY PLAN
+# для кожного і завершується з кодом 1, якщо хоч один робить повний SCAN таблиці.
+# Додаючи новий запит у хендлер — допиши його сюди.
+HOT_QUERIES = [
+    ("resolve_user", "SELECT user_id FROM users WHERE lower(username)=?", ("name",)),
+    ("user_label", "SELECT username, first_name FROM users WHERE user_id=?", (1,)),
+    ("has_card/add_card", "SELECT count FROM user_cards WHERE user_id=? AND card_id=?", (1, 1)),
+    ("kolektsiia first page", COLLECTION_FIRST_SQL.format(rarity=""), (1, 21)),
+    ("kolektsiia next page", COLLECTION_NEXT_SQL.format(rarity="AND c.rarity=?"), (1, 5, 5, 10, "легендарна", 21)),
+    ("kolektsiia prev page", COLLECTION_PREV_SQL.format(rarity=""), (1, 5, 5, 10, 21)),
+    ("duel_power", DUEL_POWER_SQL, (1,)),
+    ("user_stats", "SELECT total, common, rare, epic, legendary FROM user_stats WHERE user_id=?", (1,)),
+    ("cards by rarity", "SELECT id FROM cards WHERE rarity=?", ("легендарна",)),
+    ("delkartka", "DELETE FROM user_cards WHERE card_id=?", (1,)),
+    ("incoming duels", "SELECT id FROM duels WHERE to_user=? AND status='pending'", (1,)),
+    ("duel by id", "SELECT from_user,to_user,status,ts FROM duels WHERE id=?", (1,)),
+    ("expire duels", "SELECT id FROM duels WHERE status='pending' AND ts < ? LIMIT ?", (0, 500)),
+    ("purge duels", "SELECT id FROM duels WHERE status IN ('accepted','declined','expired') AND ts < ? LIMIT ?", (0, 500)),
+    ("weapon power", WEAPON_POWER_SQL, (1,)),
+    ("me weapons", """
+        SELECT item_id, name, power, qty FROM inventory_items
+        WHERE user_id=? AND item_type='weapon' AND qty>0
+        ORDER BY power DESC
+        LIMIT 10
+    """, (1,)),
+    ("travel", "SELECT start_ts,end_ts,claimed FROM travel WHERE user_id=?", (1,)),
+    ("pending travel", "SELECT user_id, chat_id, end_ts FROM travel WHERE claimed=0 AND notified=0 AND end_ts <= ?", (0,)),
+    ("daily_state", "SELECT day, raid_active, raid_hp, raid_hp_max, raid_killed, trader_seed FROM daily_state WHERE day=?", ("2000-01-01",)),
+    ("broadcast page", BROADCAST_PAGE_SQL, (1, 0, 50)),
+    ("raid damage", "SELECT user_id, damage FROM raid_damage WHERE day=?", ("2000-01-01",)),
+    ("purge raid hits", "SELECT rowid FROM raid_hits WHERE rowid < ? LIMIT ?", (100, 1000)),
+    ("purge raid damage", "SELECT day, user_id FROM raid_damage WHERE day < ? LIMIT ?", ("2000-01-01", 1000)),
+    ("top board", "SELECT user_id, score, rank FROM rank_snapshot WHERE board=? ORDER BY rank, user_id LIMIT 10", ("coins",)),
+    ("my rank", "SELECT score, rank FROM rank_snapshot WHERE board=? AND user_id=?", ("coins", 1)),
+]
+
+# [(назва, рядки плану, чи без повного скану)]
+def explain_hot_queries(con: sqlite3.Connection) -> list[tuple[str, list[str], bool]]:
+    report = []
+    for name, sql, params in HOT_QUERIES:
+        plan = [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        report.append((name, plan, not any(line.startswith("SCAN") for line in plan)))
+    return report
+
+def upsert_user(con: sqlite3.Connection, uid: int, username: str, first_name: str, ts: int) -> None:
     con.execute("""
         INSERT INTO users(user_id, username, first_name, last_seen_ts)
         VALUES(?,?,?,?)
         ON CONFLICT(user_id) DO UPDATE SET
           username=excluded.username,
           first_name=excluded.first_name,
-          last_seen_ts=excluded.last_seen_ts
-    """, (u.id, u.username or "", u.first_name or "", int(time.time())))
-    con.execute("INSERT OR IGNORE INTO cooldowns(user_id) VALUES(?)", (u.id,))
+          last_seen_ts=excluded.last_seen_ts,
+          blocked=0
+    """, (uid, username, first_name, ts))
+    con.execute("INSERT OR IGNORE INTO cooldowns(user_id) VALUES(?)", (uid,))
+    con.commit()
+
+def flush_users(con: sqlite3.Connection, rows: list[tuple[str, str, int, int]]) -> None:
+    # хто пише боту, той його не блокує (або вже розблокував)
+    con.executemany("UPDATE users SET username=?, first_name=?, last_seen_ts=?, blocked=0 WHERE user_id=?", rows)
     con.commit()
 
+def wal_checkpoint(con: sqlite3.Connection, mode: str):
+    return con.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+async def checkpoint_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    busy, wal_pages, done_pages = await run_db(wal_checkpoint, context.job.data)
+    if busy:
+        log.info("wal_checkpoint: БД зайнята, перенесено %s/%s сторінок", done_pages, wal_pages)
+
 def is_admin(update: Update) -> bool:
     return ADMIN_ID != 0 and update.effective_user and update.effective_user.id == ADMIN_ID
 
@@ -187,92 +896,475 @@ def resolve_user(con: sqlite3.Connection, raw: str) -> Optional[int]:
         return int(raw)
     return None
 
-def card_info(con: sqlite3.Connection, card_id: int):
-    return con.execute(
-        "SELECT id,name,rarity,weight,photo_file_id,description FROM cards WHERE id=?",
-        (card_id,)
-    ).fetchone()
+def card_info(card_id: int):
+    return CATALOG.get(card_id)
 
-def fmt_card(con: sqlite3.Connection, card_id: int) -> str:
-    row = con.execute("SELECT id,name,rarity FROM cards WHERE id=?", (card_id,)).fetchone()
+def fmt_card(card_id: int) -> str:
+    row = CATALOG.get(card_id)
     if not row:
         return f"#{card_id} (невідома)"
     return f"#{row[0]} {row[1]} ({row[2]})"
 
+# Одна команда — одна транзакція: усі зміни разом з одним commit, або жодної.
+# BEGIN IMMEDIATE одразу бере блокування запису, тож перевірка (has_card, coins)
+# і списання не розділяються чужим записом з іншого потоку БД.
+# add_card / add_coins самі не комітять — викликати лише всередині transaction().
+@contextmanager
+def transaction(con: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+    except BaseException:
+        con.rollback()
+        raise
+    con.commit()
+
 def has_card(con: sqlite3.Connection, uid: int, card_id: int, need: int) -> bool:
     row = con.execute("SELECT count FROM user_cards WHERE user_id=? AND card_id=?", (uid, card_id)).fetchone()
     return bool(row and row[0] >= need)
 
+# рідкість -> колонка в user_stats
+RARITY_STAT_COL = {
+    "звичайна": "common",
+    "рідкісна": "rare",
+    "епічна": "epic",
+    "легендарна": "legendary",
+}
+
 def add_card(con: sqlite3.Connection, uid: int, card_id: int, delta: int) -> None:
     row = con.execute("SELECT count FROM user_cards WHERE user_id=? AND card_id=?", (uid, card_id)).fetchone()
     if row is None:
-        if delta > 0:
-            con.execute("INSERT INTO user_cards(user_id, card_id, count) VALUES(?,?,?)", (uid, card_id, delta))
+        if delta <= 0:
+            return
+        con.execute("INSERT INTO user_cards(user_id, card_id, count) VALUES(?,?,?)", (uid, card_id, delta))
     else:
         new_count = row[0] + delta
         if new_count <= 0:
             con.execute("DELETE FROM user_cards WHERE user_id=? AND card_id=?", (uid, card_id))
+            delta = -row[0]
         else:
             con.execute("UPDATE user_cards SET count=? WHERE user_id=? AND card_id=?", (new_count, uid, card_id))
-    con.commit()
+    bump_user_stats(con, uid, card_id, delta)
+
+# Інкрементально оновлює user_stats у тій самій транзакції, що й user_cards.
+def bump_user_stats(con: sqlite3.Connection, uid: int, card_id: int, delta: int) -> None:
+    info = card_info(card_id)
+    if info is None:  # картку щойно додали, а каталог ще не перезавантажено
+        info = con.execute("SELECT id, name, rarity FROM cards WHERE id=?", (card_id,)).fetchone()
+    col = RARITY_STAT_COL.get(info[2]) if info else None
+    if col is None:
+        con.execute("""
+            INSERT INTO user_stats(user_id, total) VALUES(?,?)
+            ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total
+        """, (uid, delta))
+    else:
+        con.execute(f"""
+            INSERT INTO user_stats(user_id, total, {col}) VALUES(?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total, {col} = {col} + excluded.{col}
+        """, (uid, delta, delta))
+
+# Перераховує user_stats з user_cards (після видалення картки з гри).
+def refresh_user_stats(con: sqlite3.Connection, uids: list[int]) -> None:
+    con.executemany("DELETE FROM user_stats WHERE user_id=?", [(u,) for u in uids])
+    con.executemany("""
+        INSERT INTO user_stats(user_id, total, common, rare, epic, legendary)
+        SELECT uc.user_id, SUM(uc.count),
+               SUM(CASE WHEN c.rarity='звичайна' THEN uc.count ELSE 0 END),
+               SUM(CASE WHEN c.rarity='рідкісна' THEN uc.count ELSE 0 END),
+               SUM(CASE WHEN c.rarity='епічна' THEN uc.count ELSE 0 END),
+               SUM(CASE WHEN c.rarity='легендарна' THEN uc.count ELSE 0 END)
+        FROM user_cards uc JOIN cards c ON c.id = uc.card_id
+        WHERE uc.user_id=?
+        GROUP BY uc.user_id
+    """, [(u,) for u in uids])
+
+# (total, common, rare, epic, legendary)
+def get_user_stats(con: sqlite3.Connection, uid: int) -> tuple[int, int, int, int, int]:
+    row = con.execute("SELECT total, common, rare, epic, legendary FROM user_stats WHERE user_id=?", (uid,)).fetchone()
+    return row or (0, 0, 0, 0, 0)
 
 def add_coins(con: sqlite3.Connection, uid: int, delta: int) -> None:
     con.execute("UPDATE users SET coins = coins + ? WHERE user_id=?", (delta, uid))
-    con.commit()
 
-# ================== RANDOM PICK (rarity -> card) ==================
-def pick_random_card(con: sqlite3.Connection):
-    rarities = list(RARITY_CHANCE.keys())
-    weights = [RARITY_CHANCE[r] for r in rarities]
-    picked_rarity = random.choices(rarities, weights=weights, k=1)[0]
+# ================== SEEN USERS (write-behind) ==================
+# Користувачі, чиї рядки users/cooldowns уже точно є в БД (у межах цього процесу)
+KNOWN_USERS: set[int] = set()
+# uid -> (username, first_name, last_seen_ts), ще не записані в БД
+DIRTY_USERS: dict[int, tuple[str, str, int]] = {}
 
-    rows = con.execute(
-        "SELECT id,name,rarity,weight,photo_file_id,description FROM cards WHERE rarity=?",
-        (picked_rarity,)
-    ).fetchall()
+# Викликається на початку кожного хендлера. Відомий користувач — без жодного запиту:
+# профіль і last_seen лише позначаються і пишуться пачкою з flush_seen_users().
+async def touch_user(update: Update) -> None:
+    u = update.effective_user
+    if not u:
+        return
+    profile = (u.username or "", u.first_name or "", int(time.time()))
+    DIRTY_USERS[u.id] = profile
+    if u.id in KNOWN_USERS:
+        return
+    await run_db(upsert_user, u.id, *profile)
+    KNOWN_USERS.add(u.id)
 
-    if not rows:
-        rows = con.execute("SELECT id,name,rarity,weight,photo_file_id,description FROM cards").fetchall()
-        if not rows:
-            return None
+async def flush_seen_users() -> None:
+    global DIRTY_USERS
+    if not DIRTY_USERS:
+        return
+    pending, DIRTY_USERS = DIRTY_USERS, {}
+    try:
+        await run_db(flush_users, [(n, f, ts, uid) for uid, (n, f, ts) in pending.items()])
+    except Exception:
+        # повертаємо незаписане, якщо за цей час не прийшло свіжіше
+        for uid, profile in pending.items():
+            DIRTY_USERS.setdefault(uid, profile)
+        raise
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await flush_seen_users()
+    await COOLDOWNS.flush()
+
+# ================== COOLDOWNS ==================
+# вид кулдауну -> (колонка в cooldowns, тривалість)
+COOLDOWN_KINDS = {
+    "card": ("last_card_ts", CARD_COOLDOWN_SECONDS),
+    "attack": ("last_attack_ts", ATTACK_COOLDOWN_SECONDS),
+}
 
-    return random.choice(rows)
+def load_cooldowns(con: sqlite3.Connection, uid: int) -> dict[str, int]:
+    cols = [col for col, _ in COOLDOWN_KINDS.values()]
+    row = con.execute(f"SELECT {', '.join(cols)} FROM cooldowns WHERE user_id=?", (uid,)).fetchone()
+    return {kind: int(row[i]) if row else 0 for i, kind in enumerate(COOLDOWN_KINDS)}
 
-# ================== DAILY / RAID ==================
-def ensure_daily(con: sqlite3.Connection) -> None:
-    day = today_key()
-    row = con.execute("SELECT day FROM daily_state WHERE day=?", (day,)).fetchone()
-    if row:
-        return
+def save_cooldowns(con: sqlite3.Connection, rows: list[tuple]) -> None:
+    sets = ", ".join(f"{col}=?" for col, _ in COOLDOWN_KINDS.values())
+    con.executemany(f"UPDATE cooldowns SET {sets} WHERE user_id=?", rows)
+    con.commit()
+
+# Часові мітки кулдаунів у пам'яті. Користувач підвантажується з БД при першому
+# зверненні, далі перевірка і захоплення йдуть без БД і без await між ними —
+# дві одночасні спроби не можуть обидві пройти. У БД пишеться пачкою (flush).
+class Cooldowns:
+    def __init__(self):
+        self._ts: dict[int, dict[str, int]] = {}
+        self._dirty: set[int] = set()
+
+    async def _get(self, uid: int) -> dict[str, int]:
+        ts = self._ts.get(uid)
+        if ts is None:
+            loaded = await run_db(load_cooldowns, uid)
+            ts = self._ts.setdefault(uid, loaded)  # поки чекали, міг завантажити інший апдейт
+        return ts
+
+    # (True, попередня мітка) — кулдаун захоплено; (False, скільки секунд лишилось)
+    async def try_claim(self, uid: int, kind: str, now: int) -> tuple[bool, int]:
+        ts = await self._get(uid)
+        prev = ts[kind]
+        left = COOLDOWN_KINDS[kind][1] - (now - prev)
+        if left > 0:
+            return False, left
+        ts[kind] = now
+        self._dirty.add(uid)
+        return True, prev
+
+    # дія не відбулась — повертаємо попередню мітку (якщо її ще ніхто не перезахопив)
+    def release(self, uid: int, kind: str, now: int, prev: int) -> None:
+        ts = self._ts.get(uid)
+        if ts is not None and ts[kind] == now:
+            ts[kind] = prev
+            self._dirty.add(uid)
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, set()
+        rows = [(*self._ts[uid].values(), uid) for uid in pending]
+        try:
+            await run_db(save_cooldowns, rows)
+        except Exception:
+            self._dirty |= pending
+            raise
+
+COOLDOWNS = Cooldowns()
+
+# ================== CARD CATALOG (rarity -> card) ==================
+# Alias-метод (Walker/Vose): побудова O(n), кожна вибірка — O(1)
+class AliasSampler:
+    def __init__(self, items: list, weights: list[float]):
+        n = len(items)
+        total = float(sum(weights))
+        prob = [w * n / total for w in weights]
+        alias = [0] * n
+        small = [i for i, p in enumerate(prob) if p < 1.0]
+        large = [i for i, p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] = prob[l] + prob[s] - 1.0
+            (small if prob[l] < 1.0 else large).append(l)
+        for i in small + large:
+            prob[i] = 1.0
+        self._items = items
+        self._prob = prob
+        self._alias = alias
+
+    def draw(self):
+        i = random.randrange(len(self._items))
+        return self._items[i] if random.random() < self._prob[i] else self._items[self._alias[i]]
+
+# Незмінний знімок таблиці cards. Рядки мають той самий вигляд, що й
+# SELECT id,name,rarity,weight,photo_file_id,description. Картки з weight <= 0 не випадають.
+class CardCatalog:
+    def __init__(self, rows: list[tuple]):
+        self._by_id = {r[0]: r for r in rows}
+        buckets: dict[str, list[tuple]] = {}
+        for r in rows:
+            if r[3] > 0:
+                buckets.setdefault(r[2], []).append(r)
+        self._by_rarity = {rar: AliasSampler(rs, [r[3] for r in rs]) for rar, rs in buckets.items()}
+        drawable = [r for rs in buckets.values() for r in rs]
+        self._any = AliasSampler(drawable, [r[3] for r in drawable]) if drawable else None
+        rarities = list(RARITY_CHANCE.keys())
+        self._rarity = AliasSampler(rarities, [RARITY_CHANCE[r] for r in rarities])
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def get(self, card_id: int) -> Optional[tuple]:
+        return self._by_id.get(card_id)
+
+    def draw_rarity(self, rarity: str) -> Optional[tuple]:
+        sampler = self._by_rarity.get(rarity)
+        return sampler.draw() if sampler else None
+
+    # рідкість за RARITY_CHANCE, далі картка за weight; порожня рідкість -> будь-яка картка
+    def draw(self) -> Optional[tuple]:
+        card = self.draw_rarity(self._rarity.draw())
+        if card is None and self._any is not None:
+            card = self._any.draw()
+        return card
+
+CATALOG = CardCatalog([])
+
+def load_catalog(con: sqlite3.Connection) -> CardCatalog:
+    return CardCatalog(con.execute("SELECT id,name,rarity,weight,photo_file_id,description FROM cards").fetchall())
+
+def set_catalog(catalog: CardCatalog) -> None:
+    global CATALOG
+    CATALOG = catalog
+
+# після кожної зміни таблиці cards (addkartka / delkartka)
+async def reload_catalog() -> None:
+    set_catalog(await run_db(load_catalog))
+
+def pick_random_card():
+    return CATALOG.draw()
 
+# ================== DAILY / RAID ==================
+# Створює (якщо ще нема) і повертає рядок daily_state на вказаний день.
+# INSERT OR IGNORE — два одночасні "перші за день" запити не конфліктують.
+def load_daily(con: sqlite3.Connection, day: str):
     raid_active = 1 if random.random() < 0.5 else 0
     raid_hp_max = random.randint(500, 1500)
     raid_hp = raid_hp_max if raid_active else 0
     trader_seed = random.randint(1, 10**9)
 
     con.execute("""
-        INSERT INTO daily_state(day, raid_active, raid_hp, raid_hp_max, raid_killed, trader_seed)
+        INSERT OR IGNORE INTO daily_state(day, raid_active, raid_hp, raid_hp_max, raid_killed, trader_seed)
         VALUES(?,?,?,?,0,?)
     """, (day, raid_active, raid_hp, raid_hp_max, trader_seed))
     con.commit()
-
-def get_daily(con: sqlite3.Connection):
-    ensure_daily(con)
     return con.execute("""
         SELECT day, raid_active, raid_hp, raid_hp_max, raid_killed, trader_seed
         FROM daily_state WHERE day=?
-    """, (today_key(),)).fetchone()
+    """, (day,)).fetchone()
+
+def load_raid_damage(con: sqlite3.Connection, day: str) -> list[tuple[int, int]]:
+    return con.execute("SELECT user_id, damage FROM raid_damage WHERE day=?", (day,)).fetchall()
+
+# Стан рейду живе в пам'яті і змінюється лише з event loop (між await нічого не
+# перемикається), тож удари застосовуються атомарно і жоден не губиться.
+# У daily_state HP пишеться пачками (flush_raid), вбивство — одразу.
+# Удари накопичуються в pending і йдуть у raid_hits тим самим пакетом; топ гравців
+# оновлюється на кожен удар, тож /raid_top не рахує GROUP BY по журналу.
+class RaidEngine:
+    def __init__(self):
+        self.day: Optional[str] = None
+        self.active = False
+        self.hp = 0
+        self.hp_max = 0
+        self.killed = False
+        self.dirty = False
+        self.damage: dict[int, int] = {}  # uid -> сумарний урон за день
+        self.top: list[tuple[int, int]] = []  # (-урон, uid), відсортовано, не більше RAID_TOP_N
+        self.pending: list[tuple[int, int, int]] = []  # (uid, урон, ts), ще не записані
+
+    def load(self, row, damage=()) -> None:
+        day, raid_active, raid_hp, raid_hp_max, raid_killed, _seed = row
+        self.day = day
+        self.active = raid_active == 1
+        self.hp = int(raid_hp)
+        self.hp_max = int(raid_hp_max)
+        self.killed = raid_killed == 1
+        self.dirty = False
+        self.damage = {int(uid): int(dmg) for uid, dmg in damage}
+        self.top = sorted((-dmg, uid) for uid, dmg in self.damage.items())[:RAID_TOP_N]
+        self.pending = []
+
+    # урон гравця лише росте, тож у топ можна потрапити тільки власним ударом
+    def _bump_top(self, uid: int, old: int, new: int) -> None:
+        top = self.top
+        i = bisect.bisect_left(top, (-old, uid))
+        if i < len(top) and top[i] == (-old, uid):
+            del top[i]
+        elif len(top) >= RAID_TOP_N and (-new, uid) > top[-1]:
+            return
+        bisect.insort(top, (-new, uid))
+        del top[RAID_TOP_N:]
+
+    # None -> удар не зараховано (рейду нема, бос уже мертвий або день змінився);
+    # інакше (hp після удару, чи саме цей удар убив боса — рівно один раз).
+    # У журнал іде фактичний урон (не більше залишку HP), тож сума = hp_max.
+    def hit(self, day: str, uid: int, dmg: int, ts: int) -> Optional[tuple[int, bool]]:
+        if day != self.day or not self.active or self.killed:
+            return None
+        dealt = min(dmg, self.hp)
+        self.hp -= dealt
+        self.dirty = True
+        old = self.damage.get(uid, 0)
+        self.damage[uid] = old + dealt
+        self._bump_top(uid, old, old + dealt)
+        self.pending.append((uid, dealt, ts))
+        if self.hp == 0:
+            self.killed = True
+            return 0, True
+        return self.hp, False
+
+RAID = RaidEngine()
+
+def save_raid(con: sqlite3.Connection, day: str, hp: int, killed: int, hits: list[tuple[int, int, int]]) -> None:
+    per_user: dict[int, list[int]] = {}
+    for uid, dmg, _ts in hits:
+        acc = per_user.setdefault(uid, [0, 0])
+        acc[0] += dmg
+        acc[1] += 1
+    with transaction(con):
+        # HP лише падає, вбивство не скасовується — запізнілий пакет не відкотить стан
+        con.execute(
+            "UPDATE daily_state SET raid_hp=MIN(raid_hp, ?), raid_killed=MAX(raid_killed, ?) WHERE day=?",
+            (hp, killed, day)
+        )
+        con.executemany(
+            "INSERT INTO raid_hits(day, user_id, dmg, ts) VALUES(?,?,?,?)",
+            [(day, uid, dmg, ts) for uid, dmg, ts in hits]
+        )
+        con.executemany("""
+            INSERT INTO raid_damage(day, user_id, damage, hits) VALUES(?,?,?,?)
+            ON CONFLICT(day, user_id) DO UPDATE SET
+              damage=damage+excluded.damage,
+              hits=hits+excluded.hits
+        """, [(day, uid, dmg, n) for uid, (dmg, n) in per_user.items()])
+
+# Флаші (джоба, вбивство, roll_day) ідуть по черзі: інакше кожен save_raid у своєму
+# потоці БД, і пізніший коміт старішого знімка перетирав би вбивство.
+_raid_flush_lock = asyncio.Lock()
+
+async def flush_raid() -> None:
+    async with _raid_flush_lock:
+        if not RAID.dirty:
+            return
+        RAID.dirty = False
+        day = RAID.day
+        hits, RAID.pending = RAID.pending, []
+        try:
+            await run_db(save_raid, day, RAID.hp, int(RAID.killed), hits)
+        except Exception:
+            if RAID.day == day:
+                RAID.pending = hits + RAID.pending
+                RAID.dirty = True
+            raise
+
+async def flush_raid_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await flush_raid()
+
+# Поточний день тримається в пам'яті: хендлери читають DAILY / RAID без запитів.
+# Новий день створює джоба rollover_job рівно о 00:00 UTC; ensure_today() —
+# запасний шлях, якщо апдейт прийшов раніше за джобу.
+class Daily(NamedTuple):
+    day: str
+    trader_seed: int
+    ends_at: int  # unix-час наступної півночі UTC
+
+DAILY: Optional[Daily] = None
+_daily_lock = asyncio.Lock()
+
+async def roll_day() -> None:
+    global DAILY
+    now = int(time.time())
+    day = datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%d")
+    await flush_raid()
+    row = await run_db(load_daily, day)
+    RAID.load(row, await run_db(load_raid_damage, day))
+    DAILY = Daily(day, int(row[5]), (now // 86400 + 1) * 86400)
+
+async def ensure_today() -> Daily:
+    if DAILY is None or time.time() >= DAILY.ends_at:
+        async with _daily_lock:
+            if DAILY is None or time.time() >= DAILY.ends_at:
+                await roll_day()
+    return DAILY
+
+async def rollover_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await ensure_today()
+    hits, totals = await sweep_raid_log()
+    if hits or totals:
+        log.info("рейд: видалено ударів %s, сум урону %s", hits, totals)
+
+# raid_hits лише дописується, і дні йдуть по черзі (flush_raid під замком), тож
+# старі дні — це початок таблиці за rowid: межа знаходиться першим рядком
+# сканування, а видалення йде діапазоном rowid без окремого індексу по day.
+RAID_SWEEP_BATCH = 1000
+
+def raid_hits_boundary(con: sqlite3.Connection, cutoff_day: str) -> Optional[int]:
+    row = con.execute("SELECT rowid FROM raid_hits WHERE day >= ? ORDER BY rowid LIMIT 1", (cutoff_day,)).fetchone()
+    if row:
+        return row[0]
+    row = con.execute("SELECT MAX(rowid) FROM raid_hits").fetchone()
+    return row[0] + 1 if row[0] is not None else None
+
+def purge_raid_hits_chunk(con: sqlite3.Connection, boundary: int, limit: int) -> int:
+    with transaction(con):
+        return con.execute(
+            "DELETE FROM raid_hits WHERE rowid IN (SELECT rowid FROM raid_hits WHERE rowid < ? LIMIT ?)",
+            (boundary, limit)
+        ).rowcount
+
+def purge_raid_damage_chunk(con: sqlite3.Connection, cutoff_day: str, limit: int) -> int:
+    with transaction(con):
+        return con.execute("""
+            DELETE FROM raid_damage
+            WHERE (day, user_id) IN (SELECT day, user_id FROM raid_damage WHERE day < ? LIMIT ?)
+        """, (cutoff_day, limit)).rowcount
+
+# (скільки ударів видалено, скільки сум урону видалено)
+async def sweep_raid_log() -> tuple[int, int]:
+    cutoff = datetime.fromtimestamp(time.time() - RAID_LOG_RETENTION_DAYS * 86400, timezone.utc).strftime("%Y-%m-%d")
+    hits = 0
+    boundary = await run_db(raid_hits_boundary, cutoff)
+    while boundary is not None:
+        n = await run_db(purge_raid_hits_chunk, boundary, RAID_SWEEP_BATCH)
+        hits += n
+        if n < RAID_SWEEP_BATCH:
+            break
+    totals = 0
+    while True:
+        n = await run_db(purge_raid_damage_chunk, cutoff, RAID_SWEEP_BATCH)
+        totals += n
+        if n < RAID_SWEEP_BATCH:
+            break
+    return hits, totals
 
 def get_weapon_power(con: sqlite3.Connection, uid: int) -> int:
-    row = con.execute("SELECT equipped_weapon_id FROM users WHERE user_id=?", (uid,)).fetchone()
-    if not row or not row[0]:
-        return 0
-    item_id = row[0]
-    r2 = con.execute("""
-        SELECT power FROM inventory_items
-        WHERE user_id=? AND item_id=? AND item_type='weapon' AND qty>0
-    """, (uid, item_id)).fetchone()
-    return int(r2[0]) if r2 else 0
+    row = con.execute(WEAPON_POWER_SQL, (uid,)).fetchone()
+    return int(row[0]) if row else 0
 
 def has_raid_boost(con: sqlite3.Connection, uid: int) -> bool:
     now = int(time.time())
@@ -280,8 +1372,7 @@ def has_raid_boost(con: sqlite3.Connection, uid: int) -> bool:
     return bool(row and int(row[0]) > now)
 
 # ================== TRADER ==================
-def trader_items(con: sqlite3.Connection):
-    day, raid_active, raid_hp, raid_hp_max, raid_killed, seed = get_daily(con)
+def trader_items(day: str, seed: int, raid_killed: bool):
     rnd = random.Random(seed)
 
     weapon_power = rnd.choice([3, 5, 8, 12])
@@ -294,7 +1385,7 @@ def trader_items(con: sqlite3.Connection):
     pack_id = f"pack_{day}_3"
     pack_name = "Пак карт ×3"
 
-    discount = 0.85 if raid_killed == 1 else 1.0
+    discount = 0.85 if raid_killed else 1.0
 
     def price(base: int) -> int:
         return max(1, int(base * discount))
@@ -306,506 +1397,633 @@ def trader_items(con: sqlite3.Connection):
     ]
     return items, discount
 
+# Пропозиція торговця на день: item_id -> товар і готовий текст для /trader.
+# Перебудовується лише коли змінюється день або знижка (бос убитий).
+class TraderOffer(NamedTuple):
+    key: tuple[str, bool]
+    items: dict[str, dict]
+    text: str
+
+_trader_offer: Optional[TraderOffer] = None
+
+def trader_offer(daily: Daily) -> TraderOffer:
+    global _trader_offer
+    key = (daily.day, RAID.killed)
+    if _trader_offer is None or _trader_offer.key != key:
+        items, discount = trader_items(daily.day, daily.trader_seed, RAID.killed)
+        disc_text = "✅ Знижка активна (боса вбили сьогодні)!" if discount < 1.0 else "Знижки немає (бос не вбитий або рейду не було)."
+        lines = [f"{disc_text}\n\n🧳 Мандрівний торговець сьогодні продає:"]
+        for it in items:
+            lines.append(f"• {it['name']} — {it['price']} монет | item_id: `{it['item_id']}`")
+        _trader_offer = TraderOffer(key, {it["item_id"]: it for it in items}, "\n".join(lines))
+    return _trader_offer
+
 # ================== UI: BUTTONS ==================
-def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🃏 Отримати картку", callback_data="menu:get_card")],
-        [InlineKeyboardButton("📚 Колекція", callback_data="menu:collection"),
-         InlineKeyboardButton("🐉 Рейд", callback_data="menu:raid")],
-        [InlineKeyboardButton("🧳 Торговець", callback_data="menu:trader"),
-         InlineKeyboardButton("🧍 Персонаж", callback_data="menu:me")],
-        [InlineKeyboardButton("🧭 Змінити шлях", callback_data="menu:path")],
-    ])
-
-def path_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🌈 гей", callback_data="path:гей")],
-        [InlineKeyboardButton("🙂 натурал", callback_data="path:натурал")],
-        [InlineKeyboardButton("🌸 лесбійка", callback_data="path:лесбійка")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="menu:back")],
-    ])
+# Розкладки як дані: [[(текст, callback_data), ...], ...]
+MAIN_MENU_LAYOUT = [
+    [("🃏 Отримати картку", "menu:get_card")],
+    [("📚 Колекція", "menu:collection"), ("🐉 Рейд", "menu:raid")],
+    [("🧳 Торговець", "menu:trader"), ("🧍 Персонаж", "menu:me")],
+    [("🧭 Змінити шлях", "menu:path")],
+]
+
+PATH_LAYOUT = [
+    [("🌈 гей", "path:гей")],
+    [("🙂 натурал", "path:натурал")],
+    [("🌸 лесбійка", "path:лесбійка")],
+    [("⬅️ Назад", "menu:back")],
+]
+
+def build_kb(layout) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(t, callback_data=d) for t, d in row] for row in layout])
+
+# Клавіатури незмінні (TelegramObject заморожені), тож один екземпляр на весь процес
+# замість нового дерева об'єктів на кожну відповідь. Порівняння: python bench.py kb
+MAIN_MENU_KB = build_kb(MAIN_MENU_LAYOUT)
+PATH_KB = build_kb(PATH_LAYOUT)
 
 # ================== PUBLIC COMMANDS ==================
+def get_path(con: sqlite3.Connection, uid: int) -> str:
+    return con.execute("SELECT path FROM users WHERE user_id=?", (uid,)).fetchone()[0]
+
+START_TEXT = (
+    "Привіт! Я бот-гра з картками 🃏\n\n"
+    "Команди (можна і кнопками нижче):\n"
+    "/kartka — отримати карту (кулдаун 15 хв)\n"
+    "/kolektsiia [рідкість] — твоя колекція\n"
+    "/obmin10 <card_id> — 10 однакових -> легендарка 🎁\n\n"
+    "Рейд:\n"
+    "/raid\n"
+    "/attack <card_id>\n"
+    "/raid_top\n\n"
+    "Дуелі:\n"
+    "/duel <@user|user_id>\n"
+    "/duel_accept <id>\n"
+    "/duel_decline <id>\n\n"
+    "Подарунок:\n"
+    "/give <card_id> <qty> <@user|user_id>\n\n"
+    "Торговець:\n"
+    "/trader /sell /buy\n\n"
+    "Рейтинги:\n"
+    "/top [coins|cards|unique|legendary]\n\n"
+    "Персонаж:\n"
+    "/me /equip /travel_start /travel_claim\n\n"
+    "Твій шлях: {path}"
+    "\n\n(Адмін-команди приховані і тут не показуються.)"
+)
+# шляхів лише кілька — готовий текст на кожен (разом із "Обери шлях:" для нового гравця)
+START_TEXTS = {p: START_TEXT.format(path=p) for p in PATH_ALLOWED}
+START_TEXTS[""] = START_TEXT.format(path="❓ не обрано") + "\n\nОбери шлях:"
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
-    ensure_daily(con)
+    await touch_user(update)
+    path = await run_db(get_path, update.effective_user.id)
 
-    uid = update.effective_user.id
-    path = con.execute("SELECT path FROM users WHERE user_id=?", (uid,)).fetchone()[0]
-    con.close()
-
-    text = (
-        "Привіт! Я бот-гра з картками 🃏\n\n"
-        "Команди (можна і кнопками нижче):\n"
-        "/kartka — отримати карту (кулдаун 15 хв)\n"
-        "/kolektsiia — твоя колекція\n"
-        "/obmin10 <card_id> — 10 однакових -> легендарка 🎁\n\n"
-        "Рейд:\n"
-        "/raid\n"
-        "/attack <card_id>\n\n"
-        "Дуелі:\n"
-        "/duel <@user|user_id>\n"
-        "/duel_accept <id>\n"
-        "/duel_decline <id>\n\n"
-        "Подарунок:\n"
-        "/give <card_id> <qty> <@user|user_id>\n\n"
-        "Торговець:\n"
-        "/trader /sell /buy\n\n"
-        "Персонаж:\n"
-        "/me /equip /travel_start /travel_claim\n\n"
-        "Твій шлях: " + (path if path else "❓ не обрано") +
-        "\n\n(Адмін-команди приховані і тут не показуються.)"
-    )
+    text = START_TEXTS.get(path) or START_TEXT.format(path=path)
 
     if not path:
-        await reply_text(update, text + "\n\nОбери шлях:", reply_markup=path_kb())
+        await reply_text(update, text, reply_markup=PATH_KB)
     else:
-        await reply_text(update, text, reply_markup=main_menu_kb())
+        await reply_text(update, text, reply_markup=MAIN_MENU_KB)
 
 async def shliakh(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
-    con.close()
-    await reply_text(update, "Обери свій шлях:", reply_markup=path_kb())
+    await touch_user(update)
+    await reply_text(update, "Обери свій шлях:", reply_markup=PATH_KB)
+
+# кулдаун уже захоплено в kartka(); None -> нема шляху, str -> відмова
+def kartka_db(con: sqlite3.Connection, uid: int):
+    path = con.execute("SELECT path FROM users WHERE user_id=?", (uid,)).fetchone()[0]
+    if not path:
+        return None
+
+    with transaction(con):
+        card = pick_random_card()
+        if not card:
+            return "Немає карт у базі. Адмін має додати карти: /addkartka"
+
+        add_card(con, uid, card[0], +1)
+        return card
 
 async def kartka(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     now = int(time.time())
-    con = db()
-    upsert_user(con, update)
-    ensure_daily(con)
+    await touch_user(update)
 
-    path = con.execute("SELECT path FROM users WHERE user_id=?", (uid,)).fetchone()[0]
-    if not path:
-        con.close()
-        return await reply_text(update, "Спочатку обери шлях 🙂", reply_markup=path_kb())
-
-    last = con.execute("SELECT last_card_ts FROM cooldowns WHERE user_id=?", (uid,)).fetchone()[0]
-    left = CARD_COOLDOWN_SECONDS - (now - int(last))
-    if left > 0:
-        con.close()
-        mins = left // 60
-        secs = left % 60
-        return await reply_text(update, f"⏳ Кулдаун: {mins} хв {secs} сек.", reply_markup=main_menu_kb())
-
-    con.execute("UPDATE cooldowns SET last_card_ts=? WHERE user_id=?", (now, uid))
-    con.commit()
-
-    card = pick_random_card(con)
-    if not card:
-        con.close()
-        return await reply_text(update, "Немає карт у базі. Адмін має додати карти: /addkartka", reply_markup=main_menu_kb())
+    claimed, prev = await COOLDOWNS.try_claim(uid, "card", now)
+    if not claimed:
+        return await reply_text(update, f"⏳ Кулдаун: {prev // 60} хв {prev % 60} сек.", reply_markup=MAIN_MENU_KB)
 
-    card_id, name, rarity, _weight, photo, desc = card
-    add_card(con, uid, card_id, +1)
-    con.close()
+    res = await run_db(kartka_db, uid)
+    if res is None or isinstance(res, str):
+        COOLDOWNS.release(uid, "card", now, prev)
+    if res is None:
+        return await reply_text(update, "Спочатку обери шлях 🙂", reply_markup=PATH_KB)
+    if isinstance(res, str):
+        return await reply_text(update, res, reply_markup=MAIN_MENU_KB)
 
+    card_id, name, rarity, _weight, photo, desc = res
     await reply_photo(
         update,
         photo=photo,
         caption=f"🃏 {name}\n✨ Рідкість: {rarity}\n\n{desc}\n\n(id: {card_id})",
-        reply_markup=main_menu_kb()
+        reply_markup=MAIN_MENU_KB
     )
 
-async def kolektsiia(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+# Сторінка колекції. direction: "" — перша, "n" — після cursor, "p" — перед cursor.
+# -> (stats, rows, has_prev, has_next)
+def collection_page(con: sqlite3.Connection, uid: int, rarity: Optional[str], direction: str = "",
+                    cursor: tuple[int, int] = (0, 0)):
+    rar_sql, rar_args = ("AND c.rarity=?", (rarity,)) if rarity else ("", ())
+    limit = COLLECTION_PAGE_SIZE + 1  # зайвий рядок = чи є ще сторінка в цьому напрямку
+    cnt, cid = cursor
+
+    if direction == "n":
+        rows = con.execute(COLLECTION_NEXT_SQL.format(rarity=rar_sql), (uid, cnt, cnt, cid, *rar_args, limit)).fetchall()
+        has_prev, has_next = True, len(rows) > COLLECTION_PAGE_SIZE
+        rows = rows[:COLLECTION_PAGE_SIZE]
+    elif direction == "p":
+        rows = con.execute(COLLECTION_PREV_SQL.format(rarity=rar_sql), (uid, cnt, cnt, cid, *rar_args, limit)).fetchall()
+        has_prev, has_next = len(rows) > COLLECTION_PAGE_SIZE, True
+        rows = rows[:COLLECTION_PAGE_SIZE][::-1]
+    else:
+        rows = con.execute(COLLECTION_FIRST_SQL.format(rarity=rar_sql), (uid, *rar_args, limit)).fetchall()
+        has_prev, has_next = False, len(rows) > COLLECTION_PAGE_SIZE
+        rows = rows[:COLLECTION_PAGE_SIZE]
 
-    rows = con.execute("""
-        SELECT c.id, c.name, c.rarity, uc.count
-        FROM user_cards uc
-        JOIN cards c ON c.id = uc.card_id
-        WHERE uc.user_id=?
-        ORDER BY uc.count DESC, c.id ASC
-        LIMIT 80
-    """, (uid,)).fetchall()
-    con.close()
+    return get_user_stats(con, uid), rows, has_prev, has_next
 
-    if not rows:
-        return await reply_text(update, "Колекція порожня. Натисни 🃏 або /kartka", reply_markup=main_menu_kb())
+# колонка user_stats -> рідкість; вона ж — код рідкості в callback_data
+STAT_COL_RARITY = {col: rar for rar, col in RARITY_STAT_COL.items()}
+
+# callback_data: col:<n|p>:<код рідкості|all>:<count>:<card_id>
+def collection_view(rarity: Optional[str], stats, rows, has_prev: bool, has_next: bool):
+    code = RARITY_STAT_COL[rarity] if rarity else "all"
+    if rarity:
+        total = stats[1 + list(RARITY_STAT_COL).index(rarity)]
+        head = f"📚 Твоя колекція — {rarity} (всього: {total})"
+    else:
+        head = f"📚 Твоя колекція (всього: {stats[0]})"
 
-    total = sum(r[3] for r in rows)
     lines = [f"• #{cid} {name} ({rar}) × {cnt}" for cid, name, rar, cnt in rows]
-    await reply_text(update, f"📚 Твоя колекція (всього: {total})\n\n" + "\n".join(lines), reply_markup=main_menu_kb())
+    nav = []
+    if has_prev:
+        nav.append(("◀️", f"col:p:{code}:{rows[0][3]}:{rows[0][0]}"))
+    if has_next:
+        nav.append(("▶️", f"col:n:{code}:{rows[-1][3]}:{rows[-1][0]}"))
+    kb = build_kb([nav] + MAIN_MENU_LAYOUT) if nav else MAIN_MENU_KB
+    return head + "\n\n" + "\n".join(lines), kb
 
-async def obmin10(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def kolektsiia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
 
-    if len(context.args) != 1 or not context.args[0].isdigit():
-        con.close()
-        return await reply_text(update, "Формат: /obmin10 <card_id>", reply_markup=main_menu_kb())
+    args = context.args or []  # з кнопки меню аргументів нема
+    rarity = " ".join(args).strip().lower() or None
+    if rarity and rarity not in RARITY_ALLOWED:
+        return await reply_text(update, "Формат: /kolektsiia [рідкість]\nРідкості: " + ", ".join(RARITY_STAT_COL), reply_markup=MAIN_MENU_KB)
 
-    card_id = int(context.args[0])
-    if not has_card(con, uid, card_id, 10):
-        con.close()
-        return await reply_text(update, "Потрібно мати 10 однакових карт цієї id.", reply_markup=main_menu_kb())
+    stats, rows, has_prev, has_next = await run_db(collection_page, uid, rarity)
 
-    add_card(con, uid, card_id, -10)
+    if not rows:
+        if rarity:
+            return await reply_text(update, f"Карток рідкості «{rarity}» поки нема.", reply_markup=MAIN_MENU_KB)
+        return await reply_text(update, "Колекція порожня. Натисни 🃏 або /kartka", reply_markup=MAIN_MENU_KB)
 
-    legends = con.execute("""
-        SELECT id,name,rarity,weight,photo_file_id,description
-        FROM cards WHERE rarity='легендарна'
-    """).fetchall()
-    got = random.choice(legends) if legends else pick_random_card(con)
+    text, kb = collection_view(rarity, stats, rows, has_prev, has_next)
+    await reply_text(update, text, reply_markup=kb)
 
-    if not got:
-        con.close()
-        return await reply_text(update, "У базі немає карт.", reply_markup=main_menu_kb())
+async def on_collection_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    await touch_user(update)
 
-    got_id = got[0]
-    add_card(con, uid, got_id, +1)
-    con.close()
+    try:
+        _, direction, code, cnt, cid = (q.data or "").split(":")
+        cursor = (int(cnt), int(cid))
+    except ValueError:
+        return
+    if direction not in ("n", "p") or (code != "all" and code not in STAT_COL_RARITY):
+        return
+    rarity = STAT_COL_RARITY.get(code)
 
-    await reply_text(update, f"🎁 Обмін успішний! Ти отримав: {got[1]} ({got[2]}) (id: {got_id})", reply_markup=main_menu_kb())
+    stats, rows, has_prev, has_next = await run_db(collection_page, update.effective_user.id, rarity, direction, cursor)
+    if not rows:
+        # колекція змінилась між сторінками — починаємо спочатку
+        stats, rows, has_prev, has_next = await run_db(collection_page, update.effective_user.id, rarity)
+        if not rows:
+            return await edit_text(update, "Колекція порожня. Натисни 🃏 або /kartka", reply_markup=MAIN_MENU_KB)
 
-# ================== RAID ==================
-async def raid(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
-    day, raid_active, hp, hp_max, killed, _seed = get_daily(con)
-    con.close()
+    text, kb = collection_view(rarity, stats, rows, has_prev, has_next)
+    await edit_text(update, text, reply_markup=kb)
 
-    if raid_active == 0:
-        return await reply_text(update, "🛡 Сьогодні рейду немає. Завітай завтра 🙂", reply_markup=main_menu_kb())
-    if killed == 1:
-        return await reply_text(update, f"🏆 Боса вже вбили сьогодні! ({hp_max}/{hp_max})", reply_markup=main_menu_kb())
-    return await reply_text(update, f"🐉 Рейд активний!\nHP боса: {hp}/{hp_max}\nВдарити: /attack <card_id>", reply_markup=main_menu_kb())
+def obmin10_db(con: sqlite3.Connection, uid: int, card_id: int) -> str:
+    with transaction(con):
+        if not has_card(con, uid, card_id, 10):
+            return "Потрібно мати 10 однакових карт цієї id."
 
-async def attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        add_card(con, uid, card_id, -10)
+
+        got = CATALOG.draw_rarity("легендарна") or pick_random_card()
+
+        if not got:
+            return "У базі немає карт."
+
+        got_id = got[0]
+        add_card(con, uid, got_id, +1)
+        return f"🎁 Обмін успішний! Ти отримав: {got[1]} ({got[2]}) (id: {got_id})"
+
+async def obmin10(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    now = int(time.time())
-    con = db()
-    upsert_user(con, update)
-    day, raid_active, hp, hp_max, killed, _seed = get_daily(con)
-
-    if raid_active == 0:
-        con.close()
-        return await reply_text(update, "Сьогодні рейду немає.", reply_markup=main_menu_kb())
-    if killed == 1:
-        con.close()
-        return await reply_text(update, "Боса вже вбили сьогодні.", reply_markup=main_menu_kb())
-
-    last_attack = con.execute("SELECT last_attack_ts FROM cooldowns WHERE user_id=?", (uid,)).fetchone()[0]
-    left = ATTACK_COOLDOWN_SECONDS - (now - int(last_attack))
-    if left > 0:
-        con.close()
-        return await reply_text(update, f"⏳ Зачекай {left} сек. перед атакою.", reply_markup=main_menu_kb())
+    await touch_user(update)
 
     if len(context.args) != 1 or not context.args[0].isdigit():
-        con.close()
-        return await reply_text(update, "Формат: /attack <card_id>", reply_markup=main_menu_kb())
+        return await reply_text(update, "Формат: /obmin10 <card_id>", reply_markup=MAIN_MENU_KB)
 
-    card_id = int(context.args[0])
-    info = card_info(con, card_id)
+    msg = await run_db(obmin10_db, uid, int(context.args[0]))
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
+
+# ================== RAID ==================
+async def raid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await touch_user(update)
+    await ensure_today()
+    r = RAID
+
+    if not r.active:
+        return await reply_text(update, "🛡 Сьогодні рейду немає. Завітай завтра 🙂", reply_markup=MAIN_MENU_KB)
+    if r.killed:
+        return await reply_text(update, f"🏆 Боса вже вбили сьогодні! ({r.hp_max}/{r.hp_max})\nТоп: /raid_top", reply_markup=MAIN_MENU_KB)
+    return await reply_text(update, f"🐉 Рейд активний!\nHP боса: {r.hp}/{r.hp_max}\nВдарити: /attack <card_id>\nТоп: /raid_top", reply_markup=MAIN_MENU_KB)
+
+def user_labels(con: sqlite3.Connection, uids: list[int]) -> list[str]:
+    return [user_label(con, u) for u in uids]
+
+async def raid_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    await touch_user(update)
+    await ensure_today()
+    r = RAID
+
+    if not r.active:
+        return await reply_text(update, "🛡 Сьогодні рейду немає. Завітай завтра 🙂", reply_markup=MAIN_MENU_KB)
+    if not r.top:
+        return await reply_text(update, "Ще ніхто не вдарив боса. Будь першим: /attack <card_id>", reply_markup=MAIN_MENU_KB)
+
+    # знімок до await: поки читаються імена, топ може змінитися
+    top = list(r.top)
+    mine = r.damage.get(uid, 0)
+    labels = await run_db(user_labels, [u for _, u in top])
+    lines = [f"{i}. {label} — {-neg}" for i, ((neg, _), label) in enumerate(zip(top, labels), start=1)]
+    status = "🏆 переможений" if r.killed else f"HP {r.hp}/{r.hp_max}"
+    text = f"🐉 Топ рейду ({status}):\n" + "\n".join(lines) + f"\n\nТвій урон: {mine}"
+    return await reply_text(update, text, reply_markup=MAIN_MENU_KB)
+
+# int -> урон; str -> відмова
+def attack_db(con: sqlite3.Connection, uid: int, card_id: int):
+    info = card_info(card_id)
     if not info:
-        con.close()
-        return await reply_text(update, "Невірний card_id.", reply_markup=main_menu_kb())
+        return "Невірний card_id."
     if not has_card(con, uid, card_id, 1):
-        con.close()
-        return await reply_text(update, "У тебе немає цієї карти.", reply_markup=main_menu_kb())
+        return "У тебе немає цієї карти."
 
     rarity = info[2]
     dmg = RARITY_DMG.get(rarity, 5)
     if has_raid_boost(con, uid):
         dmg = int(dmg * 1.2)
     dmg += max(0, get_weapon_power(con, uid) // 2)
+    return dmg
+
+async def attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    now = int(time.time())
+    await touch_user(update)
+    await ensure_today()
+    r = RAID
 
-    hp_new = max(0, int(hp) - dmg)
+    if not r.active:
+        return await reply_text(update, "Сьогодні рейду немає.", reply_markup=MAIN_MENU_KB)
+    if r.killed:
+        return await reply_text(update, "Боса вже вбили сьогодні.", reply_markup=MAIN_MENU_KB)
 
-    con.execute("UPDATE cooldowns SET last_attack_ts=? WHERE user_id=?", (now, uid))
-    con.execute("UPDATE daily_state SET raid_hp=? WHERE day=?", (hp_new, today_key()))
-    killed_now = 0
-    if hp_new == 0:
-        con.execute("UPDATE daily_state SET raid_killed=1 WHERE day=?", (today_key(),))
-        killed_now = 1
-    con.commit()
-    con.close()
+    claimed, prev = await COOLDOWNS.try_claim(uid, "attack", now)
+    if not claimed:
+        return await reply_text(update, f"⏳ Зачекай {prev} сек. перед атакою.", reply_markup=MAIN_MENU_KB)
 
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        COOLDOWNS.release(uid, "attack", now, prev)
+        return await reply_text(update, "Формат: /attack <card_id>", reply_markup=MAIN_MENU_KB)
+
+    day = r.day
+    res = await run_db(attack_db, uid, int(context.args[0]))
+    if isinstance(res, str):
+        COOLDOWNS.release(uid, "attack", now, prev)
+        return await reply_text(update, res, reply_markup=MAIN_MENU_KB)
+
+    dmg = res
+    # поки рахувався урон, боса міг добити хтось інший
+    hit = RAID.hit(day, uid, dmg, int(time.time()))
+    if hit is None:
+        COOLDOWNS.release(uid, "attack", now, prev)
+        return await reply_text(update, "Боса вже вбили сьогодні.", reply_markup=MAIN_MENU_KB)
+
+    hp_new, killed_now = hit
     if killed_now:
+        # вбивство не чекає на пакетний flush
+        await flush_raid()
         return await reply_text(
             update,
             f"💥 Ти вдарив на {dmg}!\n🏆 БОС ПЕРЕМОЖЕНИЙ!\nСьогодні у торговця буде знижка. Перевір: /trader",
-            reply_markup=main_menu_kb()
+            reply_markup=MAIN_MENU_KB
         )
-    return await reply_text(update, f"💥 Ти вдарив на {dmg}!\nHP залишилось: {hp_new}", reply_markup=main_menu_kb())
+    return await reply_text(update, f"💥 Ти вдарив на {dmg}!\nHP залишилось: {hp_new}", reply_markup=MAIN_MENU_KB)
 
 # ================== DUELS ==================
 def duel_power(con: sqlite3.Connection, uid: int) -> int:
-    w = get_weapon_power(con, uid) * 3
-    legend_cnt = con.execute("""
-        SELECT COALESCE(SUM(uc.count),0)
-        FROM user_cards uc JOIN cards c ON c.id=uc.card_id
-        WHERE uc.user_id=? AND c.rarity='легендарна'
-    """, (uid,)).fetchone()[0]
+    row = con.execute(DUEL_POWER_SQL, (uid,)).fetchone()
+    weapon, legend_cnt = row if row else (0, 0)
+    w = int(weapon) * 3
     legend_bonus = min(30, int(legend_cnt) * 2)
     return w + legend_bonus + random.randint(1, 50)
 
-async def duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+# Заявка живе DUEL_TTL_SECONDS: прострочену не можна прийняти, навіть якщо
+# sweep_duels ще не встиг позначити її expired.
+def duel_expired(ts: int) -> bool:
+    return int(time.time()) - ts > DUEL_TTL_SECONDS
 
-    if len(context.args) != 1:
-        con.close()
-        return await reply_text(update, "Формат: /duel <@user|user_id>", reply_markup=main_menu_kb())
-
-    target = resolve_user(con, context.args[0])
+def duel_db(con: sqlite3.Connection, uid: int, raw_target: str) -> str:
+    target = resolve_user(con, raw_target)
     if not target:
-        con.close()
-        return await reply_text(update, "Я не знаю цього користувача. Нехай він/вона напише /start.", reply_markup=main_menu_kb())
+        return "Я не знаю цього користувача. Нехай він/вона напише /start."
     if target == uid:
-        con.close()
-        return await reply_text(update, "Не можна дуелитись із собою 🙂", reply_markup=main_menu_kb())
+        return "Не можна дуелитись із собою 🙂"
 
     now = int(time.time())
     con.execute("INSERT INTO duels(from_user,to_user,status,ts) VALUES(?,?, 'pending', ?)", (uid, target, now))
     duel_id = con.execute("SELECT last_insert_rowid()").fetchone()[0]
     con.commit()
-    msg = (
+    return (
         f"⚔️ Дуель-заявка створена (id: {duel_id})\n"
         f"Кому: {user_label(con, target)}\n\n"
         f"Прийняти: /duel_accept {duel_id}\n"
         f"Відхилити: /duel_decline {duel_id}"
     )
-    con.close()
-    await reply_text(update, msg, reply_markup=main_menu_kb())
+
+async def duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    await touch_user(update)
+
+    if len(context.args) != 1:
+        return await reply_text(update, "Формат: /duel <@user|user_id>", reply_markup=MAIN_MENU_KB)
+
+    msg = await run_db(duel_db, uid, context.args[0])
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
+
+def duel_accept_db(con: sqlite3.Connection, uid: int, did: int) -> str:
+    with transaction(con):
+        row = con.execute("SELECT from_user,to_user,status,ts FROM duels WHERE id=?", (did,)).fetchone()
+        if not row:
+            return "Дуель не знайдена."
+        from_u, to_u, status, ts = row
+        if to_u != uid:
+            return "Це не твоя дуель."
+        if status == "pending" and duel_expired(ts):
+            con.execute("UPDATE duels SET status='expired' WHERE id=?", (did,))
+            status = "expired"
+        if status != "pending":
+            return f"Дуель уже має статус: {status}"
+
+        p1 = duel_power(con, from_u)
+        p2 = duel_power(con, to_u)
+
+        con.execute("UPDATE duels SET status='accepted' WHERE id=?", (did,))
+
+        if p1 > p2:
+            winner, loser = from_u, to_u
+        elif p2 > p1:
+            winner, loser = to_u, from_u
+        else:
+            return f"🤝 Нічия! ({p1} vs {p2})"
+
+        add_coins(con, winner, 20)
+        add_coins(con, loser, 5)
+
+        return (
+            f"⚔️ Дуель завершена!\n"
+            f"{user_label(con, from_u)}: {p1}\n"
+            f"{user_label(con, to_u)}: {p2}\n\n"
+            f"🏆 Переміг: {user_label(con, winner)} (+20 монет)\n"
+            f"🎖 Утішний приз: {user_label(con, loser)} (+5 монет)"
+        )
 
 async def duel_accept(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
 
     if len(context.args) != 1 or not context.args[0].isdigit():
-        con.close()
-        return await reply_text(update, "Формат: /duel_accept <duel_id>", reply_markup=main_menu_kb())
+        return await reply_text(update, "Формат: /duel_accept <duel_id>", reply_markup=MAIN_MENU_KB)
+
+    msg = await run_db(duel_accept_db, uid, int(context.args[0]))
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
 
-    did = int(context.args[0])
-    row = con.execute("SELECT from_user,to_user,status FROM duels WHERE id=?", (did,)).fetchone()
+def duel_decline_db(con: sqlite3.Connection, uid: int, did: int) -> str:
+    row = con.execute("SELECT to_user,status,ts FROM duels WHERE id=?", (did,)).fetchone()
     if not row:
-        con.close()
-        return await reply_text(update, "Дуель не знайдена.", reply_markup=main_menu_kb())
-    from_u, to_u, status = row
+        return "Дуель не знайдена."
+    to_u, status, ts = row
     if to_u != uid:
-        con.close()
-        return await reply_text(update, "Це не твоя дуель.", reply_markup=main_menu_kb())
+        return "Це не твоя дуель."
+    if status == "pending" and duel_expired(ts):
+        status = "expired"
     if status != "pending":
-        con.close()
-        return await reply_text(update, f"Дуель уже має статус: {status}", reply_markup=main_menu_kb())
+        return f"Дуель уже має статус: {status}"
 
-    p1 = duel_power(con, from_u)
-    p2 = duel_power(con, to_u)
-
-    con.execute("UPDATE duels SET status='accepted' WHERE id=?", (did,))
+    con.execute("UPDATE duels SET status='declined' WHERE id=?", (did,))
     con.commit()
-
-    if p1 > p2:
-        winner, loser = from_u, to_u
-    elif p2 > p1:
-        winner, loser = to_u, from_u
-    else:
-        con.close()
-        return await reply_text(update, f"🤝 Нічия! ({p1} vs {p2})", reply_markup=main_menu_kb())
-
-    add_coins(con, winner, 20)
-    add_coins(con, loser, 5)
-
-    msg = (
-        f"⚔️ Дуель завершена!\n"
-        f"{user_label(con, from_u)}: {p1}\n"
-        f"{user_label(con, to_u)}: {p2}\n\n"
-        f"🏆 Переміг: {user_label(con, winner)} (+20 монет)\n"
-        f"🎖 Утішний приз: {user_label(con, loser)} (+5 монет)"
-    )
-    con.close()
-    await reply_text(update, msg, reply_markup=main_menu_kb())
+    return "❎ Дуель відхилено."
 
 async def duel_decline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
 
     if len(context.args) != 1 or not context.args[0].isdigit():
-        con.close()
-        return await reply_text(update, "Формат: /duel_decline <duel_id>", reply_markup=main_menu_kb())
+        return await reply_text(update, "Формат: /duel_decline <duel_id>", reply_markup=MAIN_MENU_KB)
+
+    msg = await run_db(duel_decline_db, uid, int(context.args[0]))
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
+
+# Таблиця duels не росте безмежно: прострочені заявки стають expired, а
+# завершені дуелі, старші за DUEL_RETENTION_DAYS (від створення), видаляються.
+# Обидва кроки — короткими пачками по DUEL_SWEEP_BATCH, кожна у своїй транзакції,
+# щоб не тримати блокування запису довго. id — AUTOINCREMENT, тож видалені
+# номери не повторюються і стара команда /duel_accept не влучить у нову дуель.
+def expire_duels_chunk(con: sqlite3.Connection, cutoff: int, limit: int) -> int:
+    with transaction(con):
+        return con.execute("""
+            UPDATE duels SET status='expired'
+            WHERE id IN (SELECT id FROM duels WHERE status='pending' AND ts < ? LIMIT ?)
+        """, (cutoff, limit)).rowcount
+
+def purge_duels_chunk(con: sqlite3.Connection, cutoff: int, limit: int) -> int:
+    with transaction(con):
+        return con.execute("""
+            DELETE FROM duels
+            WHERE id IN (SELECT id FROM duels WHERE status IN ('accepted','declined','expired') AND ts < ? LIMIT ?)
+        """, (cutoff, limit)).rowcount
+
+# (скільки заявок прострочено, скільки дуелей видалено)
+async def sweep_duels() -> tuple[int, int]:
+    now = int(time.time())
+    result = []
+    for chunk, cutoff in (
+        (expire_duels_chunk, now - DUEL_TTL_SECONDS),
+        (purge_duels_chunk, now - DUEL_RETENTION_DAYS * 86400),
+    ):
+        total = 0
+        while True:
+            n = await run_db(chunk, cutoff, DUEL_SWEEP_BATCH)
+            total += n
+            if n < DUEL_SWEEP_BATCH:
+                break
+        result.append(total)
+    return result[0], result[1]
+
+async def duel_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    expired, purged = await sweep_duels()
+    if expired or purged:
+        log.info("дуелі: прострочено %s, видалено %s", expired, purged)
 
-    did = int(context.args[0])
-    row = con.execute("SELECT to_user,status FROM duels WHERE id=?", (did,)).fetchone()
-    if not row:
-        con.close()
-        return await reply_text(update, "Дуель не знайдена.", reply_markup=main_menu_kb())
-    to_u, status = row
-    if to_u != uid:
-        con.close()
-        return await reply_text(update, "Це не твоя дуель.", reply_markup=main_menu_kb())
-    if status != "pending":
-        con.close()
-        return await reply_text(update, f"Дуель уже має статус: {status}", reply_markup=main_menu_kb())
+# ================== GIFTS ==================
+def give_db(con: sqlite3.Connection, uid: int, card_id: int, qty: int, raw_target: str) -> str:
+    with transaction(con):
+        target = resolve_user(con, raw_target)
+        if not target:
+            return "Я не знаю цього користувача. Нехай він/вона напише /start."
+        if target == uid:
+            return "Не можна подарувати самому собі 🙂"
 
-    con.execute("UPDATE duels SET status='declined' WHERE id=?", (did,))
-    con.commit()
-    con.close()
-    await reply_text(update, "❎ Дуель відхилено.", reply_markup=main_menu_kb())
+        if not card_info(card_id):
+            return "Невірний card_id."
+        if not has_card(con, uid, card_id, qty):
+            return "У тебе немає стільки копій цієї карти."
+
+        add_card(con, uid, card_id, -qty)
+        add_card(con, target, card_id, +qty)
+
+        return f"🎁 Подарунок відправлено!\nТи віддав: {fmt_card(card_id)} × {qty}\nКому: {user_label(con, target)}"
 
-# ================== GIFTS ==================
 async def give(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
 
     if len(context.args) != 3:
-        con.close()
-        return await reply_text(update, "Формат: /give <card_id> <qty> <@user|user_id>", reply_markup=main_menu_kb())
+        return await reply_text(update, "Формат: /give <card_id> <qty> <@user|user_id>", reply_markup=MAIN_MENU_KB)
 
     if not context.args[0].isdigit() or not context.args[1].isdigit():
-        con.close()
-        return await reply_text(update, "card_id і qty мають бути числами.", reply_markup=main_menu_kb())
+        return await reply_text(update, "card_id і qty мають бути числами.", reply_markup=MAIN_MENU_KB)
 
     card_id = int(context.args[0])
     qty = int(context.args[1])
     if qty <= 0:
-        con.close()
-        return await reply_text(update, "qty має бути > 0", reply_markup=main_menu_kb())
-
-    target = resolve_user(con, context.args[2])
-    if not target:
-        con.close()
-        return await reply_text(update, "Я не знаю цього користувача. Нехай він/вона напише /start.", reply_markup=main_menu_kb())
-    if target == uid:
-        con.close()
-        return await reply_text(update, "Не можна подарувати самому собі 🙂", reply_markup=main_menu_kb())
-
-    if not card_info(con, card_id):
-        con.close()
-        return await reply_text(update, "Невірний card_id.", reply_markup=main_menu_kb())
-    if not has_card(con, uid, card_id, qty):
-        con.close()
-        return await reply_text(update, "У тебе немає стільки копій цієї карти.", reply_markup=main_menu_kb())
-
-    add_card(con, uid, card_id, -qty)
-    add_card(con, target, card_id, +qty)
+        return await reply_text(update, "qty має бути > 0", reply_markup=MAIN_MENU_KB)
 
-    msg = f"🎁 Подарунок відправлено!\nТи віддав: {fmt_card(con, card_id)} × {qty}\nКому: {user_label(con, target)}"
-    con.close()
-    await reply_text(update, msg, reply_markup=main_menu_kb())
+    msg = await run_db(give_db, uid, card_id, qty, context.args[2])
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
 
 # ================== TRADER/SHOP ==================
+def get_coins(con: sqlite3.Connection, uid: int) -> int:
+    return int(con.execute("SELECT coins FROM users WHERE user_id=?", (uid,)).fetchone()[0])
+
 async def trader(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
-    ensure_daily(con)
+    await touch_user(update)
+    offer = trader_offer(await ensure_today())
+
+    coins = await run_db(get_coins, uid)
+    await reply_text(update, offer.text + f"\n\nТвої монети: {coins}\nКупити: /buy <item_id>", reply_markup=MAIN_MENU_KB)
+
+def sell_db(con: sqlite3.Connection, uid: int, card_id: int, qty: int) -> str:
+    with transaction(con):
+        info = card_info(card_id)
+        if not info:
+            return "Невірний card_id."
+        rarity = info[2]
+        if not has_card(con, uid, card_id, qty):
+            return "У тебе немає стільки копій цієї карти."
 
-    items, discount = trader_items(con)
-    disc_text = "✅ Знижка активна (боса вбили сьогодні)!" if discount < 1.0 else "Знижки немає (бос не вбитий або рейду не було)."
+        price_each = RARITY_SELL.get(rarity, 5)
+        total = price_each * qty
 
-    lines = [f"{disc_text}\n\n🧳 Мандрівний торговець сьогодні продає:"]
-    for it in items:
-        lines.append(f"• {it['name']} — {it['price']} монет | item_id: `{it['item_id']}`")
+        add_card(con, uid, card_id, -qty)
+        add_coins(con, uid, total)
 
-    coins = con.execute("SELECT coins FROM users WHERE user_id=?", (uid,)).fetchone()[0]
-    con.close()
-    await reply_text(update, "\n".join(lines) + f"\n\nТвої монети: {coins}\nКупити: /buy <item_id>", reply_markup=main_menu_kb())
+        coins = con.execute("SELECT coins FROM users WHERE user_id=?", (uid,)).fetchone()[0]
+        name = info[1]
+        return f"💰 Продано: #{card_id} {name} ({rarity}) × {qty}\nОтримано: {total} монет\nТепер монети: {coins}"
 
 async def sell(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
 
     if len(context.args) != 2 or not context.args[0].isdigit() or not context.args[1].isdigit():
-        con.close()
-        return await reply_text(update, "Формат: /sell <card_id> <qty>", reply_markup=main_menu_kb())
+        return await reply_text(update, "Формат: /sell <card_id> <qty>", reply_markup=MAIN_MENU_KB)
 
     card_id = int(context.args[0])
     qty = int(context.args[1])
     if qty <= 0:
-        con.close()
-        return await reply_text(update, "qty має бути > 0", reply_markup=main_menu_kb())
-
-    info = card_info(con, card_id)
-    if not info:
-        con.close()
-        return await reply_text(update, "Невірний card_id.", reply_markup=main_menu_kb())
-    rarity = info[2]
-    if not has_card(con, uid, card_id, qty):
-        con.close()
-        return await reply_text(update, "У тебе немає стільки копій цієї карти.", reply_markup=main_menu_kb())
-
-    price_each = RARITY_SELL.get(rarity, 5)
-    total = price_each * qty
-
-    add_card(con, uid, card_id, -qty)
-    add_coins(con, uid, total)
-
-    coins = con.execute("SELECT coins FROM users WHERE user_id=?", (uid,)).fetchone()[0]
-    name = info[1]
-    con.close()
-    await reply_text(update, f"💰 Продано: #{card_id} {name} ({rarity}) × {qty}\nОтримано: {total} монет\nТепер монети: {coins}", reply_markup=main_menu_kb())
+        return await reply_text(update, "qty має бути > 0", reply_markup=MAIN_MENU_KB)
+
+    msg = await run_db(sell_db, uid, card_id, qty)
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
+
+def buy_db(con: sqlite3.Connection, uid: int, item: dict) -> str:
+    with transaction(con):
+        coins = int(con.execute("SELECT coins FROM users WHERE user_id=?", (uid,)).fetchone()[0])
+        if coins < item["price"]:
+            return f"Не вистачає монет. Треба {item['price']}, у тебе {coins}."
+
+        add_coins(con, uid, -item["price"])
+
+        if item["type"] == "pack":
+            got_lines = []
+            for _ in range(3):
+                c = pick_random_card()
+                if c:
+                    add_card(con, uid, c[0], +1)
+                    got_lines.append(fmt_card(c[0]))
+            return "📦 Ти купив пак ×3 та отримав:\n" + ("\n".join(got_lines) if got_lines else "Нічого (нема карт).")
+
+        if item["type"] == "boost":
+            until = int(time.time()) + 12 * 3600
+            con.execute("UPDATE users SET raid_boost_until_ts=? WHERE user_id=?", (until, uid))
+            return "⚡ Буст активовано на 12 годин: +20% урону в рейді!"
+
+        if item["type"] == "weapon":
+            item_id = item["item_id"]
+            con.execute("""
+                INSERT INTO inventory_items(user_id,item_id,item_type,name,power,qty)
+                VALUES(?,?,?,?,?,1)
+                ON CONFLICT(user_id,item_id) DO UPDATE SET qty=qty+1
+            """, (uid, item_id, "weapon", item["name"], int(item.get("power", 0))))
+            return f"🗡 Куплено: {item['name']}!\nОдягнути: /equip {item_id}"
+
+        return "Купівля оброблена."
 
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
-    ensure_daily(con)
+    await touch_user(update)
 
     if len(context.args) != 1:
-        con.close()
-        return await reply_text(update, "Формат: /buy <item_id>", reply_markup=main_menu_kb())
+        return await reply_text(update, "Формат: /buy <item_id>", reply_markup=MAIN_MENU_KB)
 
     want_id = context.args[0].strip()
-    items, _discount = trader_items(con)
-    item = next((x for x in items if x["item_id"] == want_id), None)
+    item = trader_offer(await ensure_today()).items.get(want_id)
     if not item:
-        con.close()
-        return await reply_text(update, "Такого item_id сьогодні немає. Перевір: /trader", reply_markup=main_menu_kb())
-
-    coins = int(con.execute("SELECT coins FROM users WHERE user_id=?", (uid,)).fetchone()[0])
-    if coins < item["price"]:
-        con.close()
-        return await reply_text(update, f"Не вистачає монет. Треба {item['price']}, у тебе {coins}.", reply_markup=main_menu_kb())
-
-    add_coins(con, uid, -item["price"])
-
-    if item["type"] == "pack":
-        got_lines = []
-        for _ in range(3):
-            c = pick_random_card(con)
-            if c:
-                add_card(con, uid, c[0], +1)
-                got_lines.append(fmt_card(con, c[0]))
-        con.close()
-        return await reply_text(update, "📦 Ти купив пак ×3 та отримав:\n" + ("\n".join(got_lines) if got_lines else "Нічого (нема карт)."), reply_markup=main_menu_kb())
-
-    if item["type"] == "boost":
-        until = int(time.time()) + 12 * 3600
-        con.execute("UPDATE users SET raid_boost_until_ts=? WHERE user_id=?", (until, uid))
-        con.commit()
-        con.close()
-        return await reply_text(update, "⚡ Буст активовано на 12 годин: +20% урону в рейді!", reply_markup=main_menu_kb())
-
-    if item["type"] == "weapon":
-        item_id = item["item_id"]
-        con.execute("""
-            INSERT INTO inventory_items(user_id,item_id,item_type,name,power,qty)
-            VALUES(?,?,?,?,?,1)
-            ON CONFLICT(user_id,item_id) DO UPDATE SET qty=qty+1
-        """, (uid, item_id, "weapon", item["name"], int(item.get("power", 0))))
-        con.commit()
-        con.close()
-        return await reply_text(update, f"🗡 Куплено: {item['name']}!\nОдягнути: /equip {item_id}", reply_markup=main_menu_kb())
+        return await reply_text(update, "Такого item_id сьогодні немає. Перевір: /trader", reply_markup=MAIN_MENU_KB)
 
-    con.close()
-    await reply_text(update, "Купівля оброблена.", reply_markup=main_menu_kb())
+    msg = await run_db(buy_db, uid, item)
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
 
 # ================== CHARACTER/TRAVEL ==================
-async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
-
+def me_db(con: sqlite3.Connection, uid: int) -> str:
     coins, eq, path = con.execute("SELECT coins, equipped_weapon_id, path FROM users WHERE user_id=?", (uid,)).fetchone()
     wpower = get_weapon_power(con, uid)
     boost = "активний" if has_raid_boost(con, uid) else "нема"
@@ -831,117 +2049,268 @@ async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             travel_text = "подорож завершена — забери: /travel_claim"
 
-    con.close()
-    await reply_text(
-        update,
+    return (
         f"🧍 Персонаж\n"
         f"🧭 Шлях: {path or 'не обрано'}\n"
         f"💰 Монети: {coins}\n"
         f"🗡 Зброя: {eq or '(нема)'} (сила +{wpower})\n"
         f"⚡ Рейд-буст: {boost}\n"
         f"🧳 Подорож: {travel_text}\n\n"
-        f"🎒 Твоя зброя:\n" + "\n".join(wlines),
-        reply_markup=main_menu_kb()
+        f"🎒 Твоя зброя:\n" + "\n".join(wlines)
     )
 
-async def equip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
-
-    if len(context.args) != 1:
-        con.close()
-        return await reply_text(update, "Формат: /equip <weapon_item_id>", reply_markup=main_menu_kb())
+    await touch_user(update)
+    msg = await run_db(me_db, uid)
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
 
-    item_id = context.args[0].strip()
+def equip_db(con: sqlite3.Connection, uid: int, item_id: str) -> str:
     row = con.execute("""
         SELECT qty FROM inventory_items
         WHERE user_id=? AND item_id=? AND item_type='weapon' AND qty>0
     """, (uid, item_id)).fetchone()
     if not row:
-        con.close()
-        return await reply_text(update, "У тебе немає такої зброї.", reply_markup=main_menu_kb())
+        return "У тебе немає такої зброї."
 
     con.execute("UPDATE users SET equipped_weapon_id=? WHERE user_id=?", (item_id, uid))
     con.commit()
     power = get_weapon_power(con, uid)
-    con.close()
-    await reply_text(update, f"✅ Одягнено зброю: {item_id} (сила +{power})", reply_markup=main_menu_kb())
+    return f"✅ Одягнено зброю: {item_id} (сила +{power})"
 
-async def travel_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def equip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
 
-    if len(context.args) != 1 or not context.args[0].isdigit():
-        con.close()
-        return await reply_text(update, "Формат: /travel_start <години> (1..12)", reply_markup=main_menu_kb())
+    if len(context.args) != 1:
+        return await reply_text(update, "Формат: /equip <weapon_item_id>", reply_markup=MAIN_MENU_KB)
 
-    hours = int(context.args[0])
-    if hours < 1 or hours > 12:
-        con.close()
-        return await reply_text(update, "Години: від 1 до 12.", reply_markup=main_menu_kb())
+    msg = await run_db(equip_db, uid, context.args[0].strip())
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
 
+TRAVEL_MAX_HOURS = 12
+
+# int -> end_ts (таймер ставить хендлер); str -> відмова
+def travel_start_db(con: sqlite3.Connection, uid: int, chat_id: int, hours: int):
     now = int(time.time())
     row = con.execute("SELECT end_ts, claimed FROM travel WHERE user_id=?", (uid,)).fetchone()
     if row and row[1] == 0 and now < row[0]:
-        con.close()
-        return await reply_text(update, "Ти вже у подорожі. Дочекайся завершення або забери нагороду.", reply_markup=main_menu_kb())
+        return "Ти вже у подорожі. Дочекайся завершення або забери нагороду."
 
     end_ts = now + hours * 3600
     con.execute("""
-        INSERT INTO travel(user_id,start_ts,end_ts,claimed)
-        VALUES(?,?,?,0)
-        ON CONFLICT(user_id) DO UPDATE SET start_ts=excluded.start_ts, end_ts=excluded.end_ts, claimed=0
-    """, (uid, now, end_ts))
+        INSERT INTO travel(user_id,start_ts,end_ts,claimed,chat_id,notified)
+        VALUES(?,?,?,0,?,0)
+        ON CONFLICT(user_id) DO UPDATE SET
+          start_ts=excluded.start_ts, end_ts=excluded.end_ts, claimed=0,
+          chat_id=excluded.chat_id, notified=0
+    """, (uid, now, end_ts, chat_id))
     con.commit()
-    con.close()
-    await reply_text(update, f"🧳 Персонаж вирушив у подорож на {hours} год. Забрати: /travel_claim", reply_markup=main_menu_kb())
+    return end_ts
+
+async def travel_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    await touch_user(update)
+
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        return await reply_text(update, f"Формат: /travel_start <години> (1..{TRAVEL_MAX_HOURS})", reply_markup=MAIN_MENU_KB)
+
+    hours = int(context.args[0])
+    if hours < 1 or hours > TRAVEL_MAX_HOURS:
+        return await reply_text(update, f"Години: від 1 до {TRAVEL_MAX_HOURS}.", reply_markup=MAIN_MENU_KB)
+
+    res = await run_db(travel_start_db, uid, update.effective_chat.id, hours)
+    if isinstance(res, str):
+        return await reply_text(update, res, reply_markup=MAIN_MENU_KB)
+
+    schedule_travel(context.job_queue, uid, update.effective_chat.id, res)
+    await reply_text(
+        update,
+        f"🧳 Персонаж вирушив у подорож на {hours} год. Коли повернеться — я напишу.",
+        reply_markup=MAIN_MENU_KB
+    )
+
+def travel_claim_db(con: sqlite3.Connection, uid: int) -> str:
+    with transaction(con):
+        row = con.execute("SELECT start_ts,end_ts,claimed FROM travel WHERE user_id=?", (uid,)).fetchone()
+        if not row:
+            return "Ти ще не відправляв персонажа в подорож."
+        st, et, claimed = row
+        now = int(time.time())
+        if claimed == 1:
+            return "Нагороду вже забрано."
+        if now < et:
+            return f"Ще рано. Залишилось {et-now} сек."
+
+        coins_gain = random.randint(20, 120)
+        add_coins(con, uid, coins_gain)
+        bonus_text = f"💰 Монети: +{coins_gain}"
+
+        roll = random.random()
+        if roll < 0.15:
+            until = int(time.time()) + 6 * 3600
+            con.execute("UPDATE users SET raid_boost_until_ts=? WHERE user_id=?", (until, uid))
+            bonus_text += "\n⚡ Бонус: рейд-буст на 6 год"
+        elif roll < 0.22:
+            p = random.choice([3, 5, 8])
+            wid = f"travel_weapon_{today_key()}_{p}_{random.randint(1,9999)}"
+            name = f"Трофейна зброя +{p}"
+            con.execute("""
+                INSERT INTO inventory_items(user_id,item_id,item_type,name,power,qty)
+                VALUES(?,?,?,?,?,1)
+                ON CONFLICT(user_id,item_id) DO UPDATE SET qty=qty+1
+            """, (uid, wid, "weapon", name, p))
+            bonus_text += f"\n🗡 Знайдено: {name} (equip: /equip {wid})"
+
+        con.execute("UPDATE travel SET claimed=1 WHERE user_id=?", (uid,))
+        return "🎒 Подорож завершена! Нагорода:\n" + bonus_text
 
 async def travel_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
+    msg = await run_db(travel_claim_db, uid)
+    await reply_text(update, msg, reply_markup=MAIN_MENU_KB)
 
-    row = con.execute("SELECT start_ts,end_ts,claimed FROM travel WHERE user_id=?", (uid,)).fetchone()
-    if not row:
-        con.close()
-        return await reply_text(update, "Ти ще не відправляв персонажа в подорож.", reply_markup=main_menu_kb())
-    st, et, claimed = row
-    now = int(time.time())
-    if claimed == 1:
-        con.close()
-        return await reply_text(update, "Нагороду вже забрано.", reply_markup=main_menu_kb())
-    if now < et:
-        con.close()
-        return await reply_text(update, f"Ще рано. Залишилось {et-now} сек.", reply_markup=main_menu_kb())
-
-    coins_gain = random.randint(20, 120)
-    add_coins(con, uid, coins_gain)
-    bonus_text = f"💰 Монети: +{coins_gain}"
-
-    roll = random.random()
-    if roll < 0.15:
-        until = int(time.time()) + 6 * 3600
-        con.execute("UPDATE users SET raid_boost_until_ts=? WHERE user_id=?", (until, uid))
-        con.commit()
-        bonus_text += "\n⚡ Бонус: рейд-буст на 6 год"
-    elif roll < 0.22:
-        p = random.choice([3, 5, 8])
-        wid = f"travel_weapon_{today_key()}_{p}_{random.randint(1,9999)}"
-        name = f"Трофейна зброя +{p}"
-        con.execute("""
-            INSERT INTO inventory_items(user_id,item_id,item_type,name,power,qty)
-            VALUES(?,?,?,?,?,1)
-            ON CONFLICT(user_id,item_id) DO UPDATE SET qty=qty+1
-        """, (uid, wid, "weapon", name, p))
-        con.commit()
-        bonus_text += f"\n🗡 Знайдено: {name} (equip: /equip {wid})"
-
-    con.execute("UPDATE travel SET claimed=1 WHERE user_id=?", (uid,))
+async def on_travel_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    await touch_user(update)
+    msg = await run_db(travel_claim_db, update.effective_user.id)
+    await edit_text(update, msg)
+
+# Повернення з подорожі — разовий таймер JobQueue на travel.end_ts (один на
+# мандрівника, а не опитування /me). Після рестарту таймери відновлює
+# restore_travel_timers одним запитом по частковому індексу idx_travel_pending.
+TRAVEL_CLAIM_KB = build_kb([[("🎒 Забрати нагороду", "travel:claim")]])
+
+def schedule_travel(job_queue, uid: int, chat_id: int, end_ts: int) -> None:
+    name = f"travel:{uid}"
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    job_queue.run_once(travel_done_job, when=max(0, end_ts - time.time()), data=(uid, chat_id), name=name)
+
+# True -> цього гравця ще не сповіщали (позначка ставиться до відправки: не більше одного разу)
+def mark_travel_notified(con: sqlite3.Connection, uid: int) -> bool:
+    cur = con.execute(
+        "UPDATE travel SET notified=1 WHERE user_id=? AND claimed=0 AND notified=0 AND end_ts <= ?",
+        (uid, int(time.time()))
+    )
     con.commit()
-    con.close()
-    await reply_text(update, "🎒 Подорож завершена! Нагорода:\n" + bonus_text, reply_markup=main_menu_kb())
+    return cur.rowcount == 1
+
+async def travel_done_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    uid, chat_id = context.job.data
+    if not await run_db(mark_travel_notified, uid):
+        return
+    await send(
+        chat_id,
+        lambda: context.bot.send_message(chat_id, "🧳 Твій персонаж повернувся з подорожі!", reply_markup=TRAVEL_CLAIM_KB),
+        LANE_BROADCAST
+    )
+
+def pending_travels(con: sqlite3.Connection) -> list[tuple[int, Optional[int], int]]:
+    # подорож триває не довше TRAVEL_MAX_HOURS — діапазон охоплює всіх, хто ще в дорозі
+    horizon = int(time.time()) + TRAVEL_MAX_HOURS * 3600
+    return con.execute(
+        "SELECT user_id, chat_id, end_ts FROM travel WHERE claimed=0 AND notified=0 AND end_ts <= ?",
+        (horizon,)
+    ).fetchall()
+
+async def restore_travel_timers(job_queue) -> int:
+    rows = await run_db(pending_travels)
+    for uid, chat_id, end_ts in rows:
+        # старі записи без chat_id: у приватному чаті chat_id == user_id
+        schedule_travel(job_queue, uid, chat_id or uid, end_ts)
+    return len(rows)
+
+# ================== LEADERBOARDS ==================
+# Рейтинги не рахуються на кожен запит: джоба раз на TOP_REFRESH_SECONDS
+# перебудовує rank_snapshot (RANK() по кожній дошці), тож місце гравця — пошук
+# по первинному ключу, а текст топ-10 кешується в пам'яті до наступного перерахунку.
+TOP_BOARDS = {
+    "coins": ("💰 Монети", "SELECT user_id, coins AS score FROM users WHERE coins > 0"),
+    "cards": ("🃏 Усього карток", "SELECT user_id, total AS score FROM user_stats WHERE total > 0"),
+    "unique": ("🧩 Різних карток", "SELECT user_id, COUNT(*) AS score FROM user_cards GROUP BY user_id"),
+    "legendary": ("🌟 Легендарних", "SELECT user_id, legendary AS score FROM user_stats WHERE legendary > 0"),
+}
+TOP_SIZE = 10
+
+TOP_KB = build_kb([
+    [("💰 Монети", "top:coins"), ("🃏 Картки", "top:cards")],
+    [("🧩 Різні", "top:unique"), ("🌟 Легендарні", "top:legendary")],
+])
+
+class TopCache(NamedTuple):
+    boards: dict[str, tuple[str, int]]  # дошка -> (текст топу, скільки гравців у рейтингу)
+    built_at: int
+
+TOP: Optional[TopCache] = None
+_top_lock = asyncio.Lock()
+
+def rebuild_ranks(con: sqlite3.Connection) -> dict[str, tuple[str, int]]:
+    boards = {}
+    for board, (title, source) in TOP_BOARDS.items():
+        # окрема транзакція на дошку — блокування запису коротше; читачі (WAL)
+        # до коміту бачать попередній знімок цієї дошки
+        with transaction(con):
+            con.execute("DELETE FROM rank_snapshot WHERE board=?", (board,))
+            con.execute(f"""
+                INSERT INTO rank_snapshot(board, user_id, score, rank)
+                SELECT ?, user_id, score, RANK() OVER (ORDER BY score DESC) FROM ({source})
+            """, (board,))
+        rows = con.execute(
+            "SELECT user_id, score, rank FROM rank_snapshot WHERE board=? ORDER BY rank, user_id LIMIT ?",
+            (board, TOP_SIZE)
+        ).fetchall()
+        total = con.execute("SELECT COUNT(*) FROM rank_snapshot WHERE board=?", (board,)).fetchone()[0]
+        lines = [f"{rank}. {user_label(con, uid)} — {score}" for uid, score, rank in rows]
+        boards[board] = (f"🏅 Топ: {title}\n" + ("\n".join(lines) or "Поки що порожньо."), total)
+    return boards
+
+# force=False — лише якщо кешу ще нема: хто чекав на замок, поки інший будував,
+# бере вже готовий кеш, а не запускає ще одну повну перебудову
+async def refresh_top(force: bool = True) -> TopCache:
+    global TOP
+    async with _top_lock:
+        if force or TOP is None:
+            boards = await run_db(rebuild_ranks)
+            TOP = TopCache(boards, int(time.time()))
+    return TOP
+
+async def top_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await refresh_top()
+
+def my_rank(con: sqlite3.Connection, board: str, uid: int) -> Optional[tuple[int, int]]:
+    return con.execute("SELECT score, rank FROM rank_snapshot WHERE board=? AND user_id=?", (board, uid)).fetchone()
+
+async def top_view(uid: int, board: str) -> str:
+    # до першої top_job (first=0 — одразу після старту) хендлер лише чекає на неї
+    cache = TOP or await refresh_top(force=False)
+    text, total = cache.boards[board]
+    mine = await run_db(my_rank, board, uid)
+    if mine:
+        text += f"\n\nТвоє місце: #{mine[1]} з {total} ({mine[0]})"
+    else:
+        text += "\n\nТебе ще немає в цьому рейтингу."
+    built = datetime.fromtimestamp(cache.built_at, timezone.utc).strftime("%H:%M")
+    return text + f"\nОновлено о {built} UTC"
+
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await touch_user(update)
+    board = context.args[0].lower() if context.args else "coins"
+    if board not in TOP_BOARDS:
+        return await reply_text(update, "Формат: /top [coins|cards|unique|legendary]", reply_markup=TOP_KB)
+    await reply_text(update, await top_view(update.effective_user.id, board), reply_markup=TOP_KB)
+
+async def on_top_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    await touch_user(update)
+
+    board = (q.data or "").split(":", 1)[-1]
+    if board not in TOP_BOARDS:
+        return
+    await edit_text(update, await top_view(update.effective_user.id, board), reply_markup=TOP_KB)
 
 # ================== BUTTON CALLBACKS (FIXED) ==================
 async def on_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -951,7 +2320,7 @@ async def on_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data == "menu:back":
         # просто покажемо меню
-        return await q.message.reply_text("Меню:", reply_markup=main_menu_kb())
+        return await reply_text(update, "Меню:", reply_markup=MAIN_MENU_KB)
 
     if data == "menu:get_card":
         return await kartka(update, context)
@@ -969,7 +2338,11 @@ async def on_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await me(update, context)
 
     if data == "menu:path":
-        return await q.message.reply_text("Обери свій шлях:", reply_markup=path_kb())
+        return await reply_text(update, "Обери свій шлях:", reply_markup=PATH_KB)
+
+def set_path(con: sqlite3.Connection, uid: int, path: str) -> None:
+    con.execute("UPDATE users SET path=? WHERE user_id=?", (path, uid))
+    con.commit()
 
 async def on_path_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -978,77 +2351,305 @@ async def on_path_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chosen = data.split(":", 1)[1].strip().lower()
 
     if chosen not in PATH_ALLOWED:
-        return await q.message.reply_text("Невірний шлях.", reply_markup=path_kb())
+        return await reply_text(update, "Невірний шлях.", reply_markup=PATH_KB)
+
+    await touch_user(update)
+    await run_db(set_path, update.effective_user.id, chosen)
+
+    await reply_text(update, f"✅ Твій шлях обрано: {chosen}", reply_markup=MAIN_MENU_KB)
+
+# ================== BROADCAST ==================
+# Розсилка йде сторінками по users у порядку user_id (keyset, у пам'яті лише сторінка).
+# Кожна доставка пишеться в broadcast_deliveries одразу, як завершилась (разом із
+# лічильниками), курсор last_user_id — після сторінки. Після падіння сторінка
+# читається знову, але тим, хто вже є в broadcast_deliveries, повторно не шлеться.
+# Рядки доставок потрібні лише для продовження: sweep_broadcasts видаляє їх, щойно
+# розсилка завершилась, а самі розсилки — через BROADCAST_RETENTION_DAYS.
+BROADCAST_SWEEP_BATCH = 1000
+def create_broadcast(con: sqlite3.Connection, text: str, now: int) -> int:
+    con.execute("INSERT INTO broadcasts(text, status, created_ts) VALUES(?, 'running', ?)", (text, now))
+    bid = con.execute("SELECT last_insert_rowid()").fetchone()[0]
+    con.commit()
+    return bid
 
-    con = db()
-    upsert_user(con, update)
-    uid = update.effective_user.id
-    con.execute("UPDATE users SET path=? WHERE user_id=?", (chosen, uid))
+def running_broadcast(con: sqlite3.Connection) -> Optional[int]:
+    row = con.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1").fetchone()
+    return row[0] if row else None
+
+def broadcast_state(con: sqlite3.Connection, bid: int):
+    return con.execute(
+        "SELECT text, status, last_user_id, sent, failed, blocked FROM broadcasts WHERE id=?", (bid,)
+    ).fetchone()
+
+# -> (наступний курсор, кому ще слати); курсор іде по всіх рядках сторінки, навіть
+# якщо всі вони вже доставлені до падіння
+def broadcast_page(con: sqlite3.Connection, bid: int, after: int, limit: int) -> tuple[Optional[int], list[int]]:
+    rows = con.execute(BROADCAST_PAGE_SQL, (bid, after, limit)).fetchall()
+    if not rows:
+        return None, []
+    return rows[-1][0], [uid for uid, done in rows if not done]
+
+# Доставка записується один раз (PRIMARY KEY), лічильники — лише разом із новим рядком.
+def record_delivery(con: sqlite3.Connection, bid: int, uid: int, status: str, now: int) -> None:
+    with transaction(con):
+        cur = con.execute(
+            "INSERT OR IGNORE INTO broadcast_deliveries(broadcast_id, user_id, status, ts) VALUES(?,?,?,?)",
+            (bid, uid, status, now)
+        )
+        if cur.rowcount == 0:
+            return
+        if status == "blocked":
+            con.execute("UPDATE users SET blocked=1 WHERE user_id=?", (uid,))
+        con.execute(f"UPDATE broadcasts SET {status}={status}+1 WHERE id=?", (bid,))
+
+def set_broadcast_cursor(con: sqlite3.Connection, bid: int, cursor: int) -> None:
+    con.execute("UPDATE broadcasts SET last_user_id=? WHERE id=?", (cursor, bid))
     con.commit()
-    con.close()
 
-    await q.message.reply_text(f"✅ Твій шлях обрано: {chosen}", reply_markup=main_menu_kb())
+# завершити можна лише активну розсилку: запис 'done' з уже скасованої задачі
+# (потік БД доробляє його й після cancel) не перетре 'cancelled'
+def set_broadcast_status(con: sqlite3.Connection, bid: int, status: str) -> None:
+    con.execute("UPDATE broadcasts SET status=? WHERE id=? AND status='running'", (status, bid))
+    con.commit()
+
+# остання розсилка: (id, broadcast_state, скільки ще отримувачів) або None
+def broadcast_status_db(con: sqlite3.Connection):
+    row = con.execute("SELECT id FROM broadcasts ORDER BY id DESC LIMIT 1").fetchone()
+    if not row:
+        return None
+    state = broadcast_state(con, row[0])
+    left = con.execute("SELECT COUNT(*) FROM users WHERE user_id > ? AND blocked = 0", (state[2],)).fetchone()[0]
+    return row[0], state, left
+
+# -> sent / blocked / failed; на відміну від send() чекає саме результат відправки
+async def deliver(tg_bot, uid: int, text: str) -> str:
+    factory = lambda: tg_bot.send_message(chat_id=uid, text=text)
+    try:
+        if SENDER.running:
+            await SENDER.submit(uid, factory, LANE_BROADCAST)
+        else:
+            await factory()
+        return "sent"
+    except Forbidden:
+        return "blocked"
+    except Exception:
+        return "failed"
+
+async def deliver_and_record(tg_bot, bid: int, uid: int, text: str) -> None:
+    status = await deliver(tg_bot, uid, text)
+    # вже надіслане дописуємо навіть при зупинці розсилки, інакше повториться
+    rec = asyncio.ensure_future(run_db(record_delivery, bid, uid, status, int(time.time())))
+    try:
+        await asyncio.shield(rec)
+    except asyncio.CancelledError:
+        await rec
+        raise
+
+async def run_broadcast(tg_bot, bid: int) -> None:
+    text, status, cursor, *_ = await run_db(broadcast_state, bid)
+    while True:
+        next_cursor, page = await run_db(broadcast_page, bid, cursor, BROADCAST_PAGE)
+        if next_cursor is None:
+            break
+        tasks = []
+        try:
+            for uid in page:
+                tasks.append(asyncio.create_task(deliver_and_record(tg_bot, bid, uid, text)))
+                await asyncio.sleep(1 / BROADCAST_RATE)
+            await asyncio.gather(*tasks)
+        finally:
+            # зупинка посеред сторінки: ненадіслане з черги знімається; записане
+            # у broadcast_deliveries при продовженні пропускається
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await run_db(set_broadcast_cursor, bid, next_cursor)
+        cursor = next_cursor
+
+    await run_db(set_broadcast_status, bid, "done")
+    _text, _status, _cursor, sent, failed, blocked = await run_db(broadcast_state, bid)
+    if ADMIN_ID:
+        await send(ADMIN_ID, lambda: tg_bot.send_message(
+            chat_id=ADMIN_ID, text=f"📣 Розсилку #{bid} завершено: надіслано {sent}, помилок {failed}, заблокували {blocked}."
+        ))
+
+BROADCAST_TASK: Optional[asyncio.Task] = None
+
+def start_broadcast_task(tg_bot, bid: int) -> None:
+    global BROADCAST_TASK
+    # create_task копіює поточний контекст: з хендлера /broadcast уся фонова розсилка
+    # рахувалась би в його метриках. Порожній контекст — запити йдуть у "(фон)".
+    BROADCAST_TASK = Context().run(asyncio.create_task, run_broadcast(tg_bot, bid), name=f"broadcast-{bid}")
+    BROADCAST_TASK.add_done_callback(_broadcast_done)
+
+def _broadcast_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        log.error("розсилка впала (продовжиться після перезапуску)", exc_info=task.exception())
+
+# зупинка бота: розсилка лишається 'running' і продовжиться при наступному старті
+async def stop_broadcast_task() -> None:
+    task = BROADCAST_TASK
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+def purge_deliveries_chunk(con: sqlite3.Connection, limit: int) -> int:
+    with transaction(con):
+        return con.execute("""
+            DELETE FROM broadcast_deliveries
+            WHERE (broadcast_id, user_id) IN (
+                SELECT d.broadcast_id, d.user_id
+                FROM broadcasts b JOIN broadcast_deliveries d ON d.broadcast_id = b.id
+                WHERE b.status != 'running'
+                LIMIT ?
+            )
+        """, (limit,)).rowcount
+
+def purge_broadcasts(con: sqlite3.Connection, cutoff: int) -> int:
+    with transaction(con):
+        return con.execute("DELETE FROM broadcasts WHERE status != 'running' AND created_ts < ?", (cutoff,)).rowcount
+
+# (скільки рядків доставок видалено, скільки старих розсилок видалено)
+async def sweep_broadcasts() -> tuple[int, int]:
+    deliveries = 0
+    while True:
+        n = await run_db(purge_deliveries_chunk, BROADCAST_SWEEP_BATCH)
+        deliveries += n
+        if n < BROADCAST_SWEEP_BATCH:
+            break
+    old = await run_db(purge_broadcasts, int(time.time()) - BROADCAST_RETENTION_DAYS * 86400)
+    return deliveries, old
+
+async def broadcast_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    deliveries, old = await sweep_broadcasts()
+    if deliveries or old:
+        log.info("розсилки: видалено доставок %s, старих розсилок %s", deliveries, old)
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await touch_user(update)
+    if not is_admin(update):
+        return await reply_text(update, "Команда недоступна.")
+
+    text = (update.effective_message.text or "").partition(" ")[2].strip()
+    if not text:
+        return await reply_text(update, "Формат: /broadcast <текст повідомлення>")
+
+    if BROADCAST_TASK and not BROADCAST_TASK.done():
+        return await reply_text(update, "Вже йде розсилка. Стан: /broadcast_status, зупинити: /broadcast_cancel")
+
+    bid = await run_db(create_broadcast, text, int(time.time()))
+    start_broadcast_task(context.bot, bid)
+    await reply_text(update, f"📣 Розсилку #{bid} запущено ({BROADCAST_RATE:g}/с). Стан: /broadcast_status")
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await touch_user(update)
+    if not is_admin(update):
+        return await reply_text(update, "Команда недоступна.")
+
+    res = await run_db(broadcast_status_db)
+    if res is None:
+        return await reply_text(update, "Розсилок ще не було.")
+    bid, (_text, status, _cursor, sent, failed, blocked), left = res
+    left_text = f"\nЗалишилось: ~{left}" if status == "running" else ""
+    await reply_text(update, f"📣 Розсилка #{bid}: {status}\nНадіслано: {sent}\nПомилок: {failed}\nЗаблокували бота: {blocked}{left_text}")
+
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await touch_user(update)
+    if not is_admin(update):
+        return await reply_text(update, "Команда недоступна.")
+
+    bid = await run_db(running_broadcast)
+    if bid is None:
+        return await reply_text(update, "Немає активної розсилки.")
+    # спершу зупинити задачу, щоб вона вже нічого не слала після 'cancelled'
+    await stop_broadcast_task()
+    await run_db(set_broadcast_status, bid, "cancelled")
+    await reply_text(update, f"⏹ Розсилку #{bid} зупинено.")
 
 # ================== ADMIN (HIDDEN) ==================
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
     if not is_admin(update):
-        con.close()
         return await reply_text(update, "Команда недоступна.")
-    con.close()
     await reply_text(
         update,
         "👑 Адмін-панель (прихована)\n\n"
         "/addkartka — додати картку (фото→назва→рідкість→опис)\n"
         "/listkartky — список карток\n"
         "/delkartka <id> — видалити картку\n"
+        "/stats — швидкодія хендлерів\n"
+        "/broadcast <текст> — розсилка всім (/broadcast_status, /broadcast_cancel)\n"
         "/cancel — скасувати додавання\n\n"
         "⚠️ Вага (шанс) тепер НЕ вводиться — визначається автоматично за рідкістю."
     )
 
+def fmt_ms(seconds: float) -> str:
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:.0f}"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await touch_user(update)
+    if not is_admin(update):
+        return await reply_text(update, "Команда недоступна.")
+
+    if not METRICS:
+        return await reply_text(update, "Ще нічого не виміряно.")
+
+    lines = ["📊 Хендлери з моменту запуску (за сумарним часом)",
+             "назва: викликів | сер. мс | p99 ≤ мс | SQL/викл. | SQL мс/викл. | коміти | помилки"]
+    for name, st in sorted(METRICS.items(), key=lambda kv: kv[1].latency_sum + kv[1].sql_seconds, reverse=True):
+        n = max(1, st.calls)
+        lines.append(
+            f"{name}: {st.calls} | {st.latency_sum / n * 1000:.1f} | {fmt_ms(st.quantile(0.99)) if st.calls else '–'} | "
+            f"{st.sql_count / n:.1f} | {st.sql_seconds / n * 1000:.1f} | {st.commits} | {st.errors}"
+        )
+    await reply_text(update, "\n".join(lines))
+
+def list_cards(con: sqlite3.Connection):
+    return con.execute("SELECT id,name,rarity FROM cards ORDER BY id DESC").fetchall()
+
 async def listkartky(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
     if not is_admin(update):
-        con.close()
         return await reply_text(update, "Команда недоступна.")
 
-    rows = con.execute("SELECT id,name,rarity FROM cards ORDER BY id DESC").fetchall()
-    con.close()
+    rows = await run_db(list_cards)
     if not rows:
         return await reply_text(update, "Порожньо. Додай: /addkartka")
 
     await reply_text(update, "🗂 Картки:\n" + "\n".join([f"#{i} — {n} ({r})" for i, n, r in rows[:80]]))
 
+# None -> такої картки нема; інакше — назва видаленої
+def delete_card(con: sqlite3.Connection, cid: int) -> Optional[str]:
+    row = con.execute("SELECT id,name FROM cards WHERE id=?", (cid,)).fetchone()
+    if not row:
+        return None
+
+    with transaction(con):
+        owners = [r[0] for r in con.execute("SELECT user_id FROM user_cards WHERE card_id=?", (cid,))]
+        con.execute("DELETE FROM cards WHERE id=?", (cid,))
+        con.execute("DELETE FROM user_cards WHERE card_id=?", (cid,))
+        refresh_user_stats(con, owners)
+    return row[1]
+
 async def delkartka(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
+    await touch_user(update)
     if not is_admin(update):
-        con.close()
         return await reply_text(update, "Команда недоступна.")
 
     if len(context.args) != 1 or not context.args[0].isdigit():
-        con.close()
         return await reply_text(update, "Формат: /delkartka <id>")
 
     cid = int(context.args[0])
-    row = con.execute("SELECT id,name FROM cards WHERE id=?", (cid,)).fetchone()
-    if not row:
-        con.close()
+    name = await run_db(delete_card, cid)
+    if name is None:
         return await reply_text(update, "Такої картки нема.")
+    await reload_catalog()
 
-    con.execute("DELETE FROM cards WHERE id=?", (cid,))
-    con.execute("DELETE FROM user_cards WHERE card_id=?", (cid,))
-    con.commit()
-    con.close()
-    await reply_text(update, f"🗑 Видалено картку #{cid} ({row[1]})")
+    await reply_text(update, f"🗑 Видалено картку #{cid} ({name})")
 
 # ---- /addkartka conversation (без ваги) ----
 async def addkartka_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    con = db()
-    upsert_user(con, update)
-    con.close()
+    await touch_user(update)
 
     if not is_admin(update):
         await reply_text(update, "Команда недоступна.")
@@ -1099,6 +2700,13 @@ async def addkartka_desc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await reply_photo(update, photo=c["photo_file_id"], caption=preview)
     return CONFIRM
 
+def insert_card(con: sqlite3.Connection, c: dict) -> None:
+    con.execute(
+        "INSERT INTO cards(name,rarity,weight,photo_file_id,description) VALUES (?,?,?,?,?)",
+        (c["name"], c["rarity"], 1, c["photo_file_id"], c["description"])
+    )
+    con.commit()
+
 async def addkartka_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ans = (update.effective_message.text or "").strip().lower()
     if ans not in {"так", "ні"}:
@@ -1111,21 +2719,16 @@ async def addkartka_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     c = context.user_data["new_card"]
-    con = db()
-    con.execute(
-        "INSERT INTO cards(name,rarity,weight,photo_file_id,description) VALUES (?,?,?,?,?)",
-        (c["name"], c["rarity"], 1, c["photo_file_id"], c["description"])
-    )
-    con.commit()
-    con.close()
+    await run_db(insert_card, c)
+    await reload_catalog()
     context.user_data.pop("new_card", None)
 
-    await reply_text(update, "✅ Картку додано! Перевір: /kartka", reply_markup=main_menu_kb())
+    await reply_text(update, "✅ Картку додано! Перевір: /kartka", reply_markup=MAIN_MENU_KB)
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop("new_card", None)
-    await reply_text(update, "Ок, скасовано.", reply_markup=main_menu_kb())
+    await reply_text(update, "Ок, скасовано.", reply_markup=MAIN_MENU_KB)
     return ConversationHandler.END
 
 # ================== EXTRA ==================
@@ -1134,17 +2737,94 @@ async def my_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await reply_text(update, f"Твій ID: {uid}")
 
 # ================== MAIN ==================
+async def on_startup(app: Application) -> None:
+    await ensure_today()
+    SENDER.start()
+    n = await restore_travel_timers(app.job_queue)
+    if n:
+        log.info("відновлено таймерів подорожей: %s", n)
+    bid = await run_db(running_broadcast)
+    if bid is not None:
+        log.info("продовжую розсилку #%s", bid)
+        start_broadcast_task(app.bot, bid)
+
+async def on_stop(app: Application) -> None:
+    await stop_broadcast_task()
+    await SENDER.stop(SEND_DRAIN_SECONDS)
+
+async def on_shutdown(app: Application) -> None:
+    await flush_seen_users()
+    await COOLDOWNS.flush()
+    await flush_raid()
+    if METRICS_FILE:
+        write_metrics_file(METRICS_FILE, render_prometheus())
+    close_pool()
+
+def _check_min(name: str, value: float, minimum: float) -> None:
+    if value < minimum:
+        raise RuntimeError(f"{name} має бути >= {minimum}, а не {value}")
+
+# Розміри й інтервали з env перевіряються до open_pool()/migrate(): з поганим
+# значенням бот не стартує і game.db лишається недоторканою.
+def check_config() -> None:
+    _check_min("USER_FLUSH_SECONDS", USER_FLUSH_SECONDS, 1)
+    _check_min("RAID_FLUSH_SECONDS", RAID_FLUSH_SECONDS, 1)
+    _check_min("COLLECTION_PAGE_SIZE", COLLECTION_PAGE_SIZE, 1)
+    if METRICS_FILE:
+        _check_min("METRICS_FILE_SECONDS", METRICS_FILE_SECONDS, 1)
+    _check_min("UPDATE_CONCURRENCY", UPDATE_CONCURRENCY, 1)
+    # TokenBucket ділить на швидкість: 0 — ділення на нуль при першій відправці
+    if SEND_GLOBAL_RATE <= 0 or SEND_CHAT_RATE <= 0:
+        raise RuntimeError(f"SEND_GLOBAL_RATE і SEND_CHAT_RATE мають бути > 0, а не {SEND_GLOBAL_RATE:g} / {SEND_CHAT_RATE:g}")
+    _check_min("SEND_CHAT_BURST", SEND_CHAT_BURST, 1)
+    _check_min("SEND_WORKERS", SEND_WORKERS, 1)
+    _check_min("SEND_MAX_RETRIES", SEND_MAX_RETRIES, 0)
+    _check_min("SEND_DRAIN_SECONDS", SEND_DRAIN_SECONDS, 0)
+    if BROADCAST_RATE <= 0:
+        raise RuntimeError(f"BROADCAST_RATE має бути > 0, а не {BROADCAST_RATE:g}")
+    _check_min("BROADCAST_PAGE", BROADCAST_PAGE, 1)
+    # від'ємне — межа в майбутньому, і прибирання видалило б свіжі розсилки
+    _check_min("BROADCAST_RETENTION_DAYS", BROADCAST_RETENTION_DAYS, 0)
+    # з пачкою < 1 (LIMIT 0 / LIMIT -1) sweep_duels ніколи не вийде з циклу
+    _check_min("DUEL_SWEEP_BATCH", DUEL_SWEEP_BATCH, 1)
+    _check_min("DUEL_SWEEP_SECONDS", DUEL_SWEEP_SECONDS, 1)
+    _check_min("DUEL_TTL_SECONDS", DUEL_TTL_SECONDS, 1)
+    _check_min("DUEL_RETENTION_DAYS", DUEL_RETENTION_DAYS, 0)
+    _check_min("TOP_REFRESH_SECONDS", TOP_REFRESH_SECONDS, 1)
+    _check_min("RAID_TOP_N", RAID_TOP_N, 1)
+    _check_min("RAID_LOG_RETENTION_DAYS", RAID_LOG_RETENTION_DAYS, 0)
+
 def main():
     if not TOKEN:
         raise RuntimeError("Немає BOT_TOKEN. Перевір .env (BOT_TOKEN=...) і перезапусти.")
-
-    con = db()
-    con.close()
-
-    app = Application.builder().token(TOKEN).build()
+    mode = _pragma_choice("BOT_MODE", BOT_MODE, {"POLLING", "WEBHOOK"})
+    webhook = webhook_settings() if mode == "WEBHOOK" else None
+    check_config()
+
+    open_pool()
+    with db() as con:
+        migrate(con)
+        set_catalog(load_catalog(con))
+
+    builder = (
+        Application.builder()
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(KeyedUpdateProcessor(UPDATE_CONCURRENCY))
+        .job_queue(BackgroundJobQueue())
+    )
+    if webhook and not webhook["webhook_url"]:
+        builder = builder.bot(LocalWebhookBot(TOKEN))
+    else:
+        builder = builder.token(TOKEN)
+    app = builder.build()
 
     # callbacks (кнопки)
     app.add_handler(CallbackQueryHandler(on_menu_button, pattern=r"^menu:"))
+    app.add_handler(CallbackQueryHandler(on_collection_page, pattern=r"^col:"))
+    app.add_handler(CallbackQueryHandler(on_top_page, pattern=r"^top:"))
+    app.add_handler(CallbackQueryHandler(on_travel_claim, pattern=r"^travel:"))
     app.add_handler(CallbackQueryHandler(on_path_button, pattern=r"^path:"))
 
     # public commands
@@ -1157,8 +2837,12 @@ def main():
 
     # raid
     app.add_handler(CommandHandler("raid", raid))
+    app.add_handler(CommandHandler("raid_top", raid_top))
     app.add_handler(CommandHandler("attack", attack))
 
+    # leaderboards
+    app.add_handler(CommandHandler("top", top))
+
     # duels
     app.add_handler(CommandHandler("duel", duel))
     app.add_handler(CommandHandler("duel_accept", duel_accept))
@@ -1182,6 +2866,10 @@ def main():
     app.add_handler(CommandHandler("admin", admin))
     app.add_handler(CommandHandler("listkartky", listkartky))
     app.add_handler(CommandHandler("delkartka", delkartka))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("broadcast", broadcast))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel))
 
     add_conv = ConversationHandler(
         entry_points=[CommandHandler("addkartka", addkartka_start)],
@@ -1197,8 +2885,129 @@ def main():
     )
     app.add_handler(add_conv)
     app.add_handler(CommandHandler("cancel", cancel))
+    instrument_handlers(app)
+
+    # jobs
+    app.job_queue.run_repeating(flush_users_job, interval=USER_FLUSH_SECONDS, name="flush_users")
+    app.job_queue.run_repeating(flush_raid_job, interval=RAID_FLUSH_SECONDS, name="flush_raid")
+    app.job_queue.run_repeating(top_job, interval=TOP_REFRESH_SECONDS, first=0, name="top_refresh")
+    app.job_queue.run_repeating(duel_sweep_job, interval=DUEL_SWEEP_SECONDS, first=10, name="duel_sweep")
+    app.job_queue.run_repeating(broadcast_sweep_job, interval=3600, first=30, name="broadcast_sweep")
+    app.job_queue.run_daily(rollover_job, time=dtime(0, 0, tzinfo=timezone.utc), name="daily_rollover")
+    if DB_CHECKPOINT_SECONDS > 0 and DB_JOURNAL_MODE.strip().upper() == "WAL":
+        mode = _pragma_choice("DB_CHECKPOINT_MODE", DB_CHECKPOINT_MODE, {"PASSIVE", "FULL", "RESTART", "TRUNCATE"})
+        app.job_queue.run_repeating(checkpoint_job, interval=DB_CHECKPOINT_SECONDS, data=mode, name="wal_checkpoint")
+    if METRICS_FILE:
+        app.job_queue.run_repeating(metrics_file_job, interval=METRICS_FILE_SECONDS, name="metrics_file")
+
+    if webhook:
+        app.run_webhook(**webhook)
+    else:
+        app.run_polling()
+
+# ================== UPDATE ORDERING ==================
+DUEL_COMMANDS = {"/duel_accept", "/duel_decline"}
+
+# Ключі, за якими апдейти впорядковуються: користувач (усі його команди і кроки
+# /addkartka), а для /duel_accept і /duel_decline — ще й сама дуель.
+def update_keys(update: object) -> list[tuple[str, int]]:
+    if not isinstance(update, Update):
+        return []
+    keys = []
+    if update.effective_user:
+        keys.append(("user", update.effective_user.id))
+    elif update.effective_chat:
+        keys.append(("chat", update.effective_chat.id))
+
+    text = update.message.text if update.message and update.message.text else ""
+    parts = text.split()
+    if len(parts) == 2 and parts[0].split("@")[0] in DUEL_COMMANDS and parts[1].isdigit():
+        keys.append(("duel", int(parts[1])))
+    # спершу користувач, потім дуель: так черга користувача не залежить від чужих дуелей,
+    # а дедлоку нема — замок дуелі береться лише останнім
+    return keys
+
+# Апдейти різних користувачів ідуть паралельно (не більше UPDATE_CONCURRENCY),
+# а апдейти з однаковим ключем — строго в порядку надходження: asyncio.Lock віддає
+# замок чергою, а задачі стартують у порядку створення. Замок береться ДО ліміту
+# паралельності, тож користувач, що спамить, чекає в черзі, не займаючи слотів інших.
+# process_update у PTB фінальний і сам тримає семафор, тому базовому класу дається
+# ліміт, якого не досягти, а справжній — власний семафор після замків.
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(2 ** 31 - 1)
+        self._limit = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # ключ -> [замок, скільки апдейтів його тримає або чекає]
+        self._locks: dict[tuple[str, int], list] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        keys = update_keys(update)
+        entries = [self._locks.setdefault(k, [asyncio.Lock(), 0]) for k in keys]
+        for e in entries:
+            e[1] += 1
+        try:
+            async with AsyncExitStack() as stack:
+                for lock, _n in entries:
+                    await stack.enter_async_context(lock)
+                async with self._limit:
+                    await coroutine
+        finally:
+            for k, e in zip(keys, entries):
+                e[1] -= 1
+                if e[1] == 0:
+                    del self._locks[k]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ================== WEBHOOK ==================
+# Локальний режим вебхука: Telegram про наш сервер не знає, тож і реєструвати нічого.
+# Відповіді все одно йдуть через справжній Bot API.
+class LocalWebhookBot(ExtBot):
+    async def set_webhook(self, *args, **kwargs) -> bool:
+        log.info("WEBHOOK_URL не задано: вебхук у Telegram не реєструється")
+        return True
+
+def webhook_settings() -> dict:
+    if not 1 <= WEBHOOK_MAX_CONNECTIONS <= 100:
+        raise RuntimeError(f"WEBHOOK_MAX_CONNECTIONS має бути 1..100, а не {WEBHOOK_MAX_CONNECTIONS}")
+    if WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_SECRET: лише A-Z, a-z, 0-9, _ і -, до 256 символів")
+    if bool(WEBHOOK_CERT) != bool(WEBHOOK_KEY):
+        raise RuntimeError("Для TLS потрібні обидва: WEBHOOK_CERT і WEBHOOK_KEY")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        log.warning("WEBHOOK_SECRET не задано: сервер прийме апдейт від будь-кого, хто знає шлях")
+
+    path = WEBHOOK_PATH.strip("/")
+    return dict(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=path,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{path}" if WEBHOOK_URL else None,
+        secret_token=WEBHOOK_SECRET or None,
+        cert=WEBHOOK_CERT or None,
+        key=WEBHOOK_KEY or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
 
-    app.run_polling()
+def check_query_plans() -> int:
+    open_pool()
+    try:
+        with db() as con:
+            migrate(con)
+            report = explain_hot_queries(con)
+    finally:
+        close_pool()
+    for name, plan, ok in report:
+        print(("OK   " if ok else "SCAN ") + name)
+        for line in plan:
+            print("       " + line)
+    return 0 if all(ok for _name, _plan, ok in report) else 1
 
 if __name__ == "__main__":
+    if "--explain" in sys.argv[1:]:
+        sys.exit(check_query_plans())
     main()